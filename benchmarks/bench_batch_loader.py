@@ -0,0 +1,64 @@
+#!/bin/env python2
+
+# Compare concurrent single-food lookups, each with its own query, with the
+# batched lookups of loaderservice.FoodLoader, counting the statements that
+# each method sends to the database.
+
+import argparse
+import os
+import random
+import sys
+import threading
+import time
+import yaml
+from sqlalchemy import select
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from usdanutrient import engineservice, instrumentation, loaderservice, model
+
+def fan_out(num_threads, food_ids, lookup):
+    # Splits the lookups of the food ids between the threads
+    threads = [threading.Thread(target=lambda ids=food_ids[ind::num_threads]: [lookup(food_id) for food_id in ids])
+               for ind in range(num_threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+def run_single(engine, num_threads, food_ids):
+    fan_out(num_threads, food_ids,
+            lambda food_id: loaderservice.query_nutrient_values(engine, [food_id]))
+
+def run_batched(engine, num_threads, food_ids):
+    with loaderservice.FoodLoader(engine, max_concurrency=num_threads) as loader:
+        fan_out(num_threads, food_ids, loader.get_nutrient_values)
+
+METHODS = [('single', run_single), ('batched', run_batched)]
+
+if __name__ == '__main__':
+    config_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), '../conf/usdanutrient.yml')
+    with open(config_path) as f:
+        config = yaml.safe_load(f)
+
+    arg_parser = argparse.ArgumentParser(description='Benchmark single lookups against batched lookups')
+    arg_parser.add_argument('--threads', '-t', dest='threads', help='Number of concurrent threads', type=int, default=8)
+    arg_parser.add_argument('--lookups', '-n', dest='lookups', help='Number of foods looked up', type=int, default=2000)
+    args = arg_parser.parse_args()
+
+    # The pool must hold a connection for every thread
+    config['database']['pool'] = {'size': args.threads, 'max_overflow': 0}
+    router = engineservice.create_router(config)
+    engine = router.get_read_engine()
+    all_ids = [row[0] for row in engine.execute(select([model.Food.__table__.c.id]))]
+    food_ids = [random.choice(all_ids) for ind in range(args.lookups)]
+
+    print("{:<8} {:>8} {:>11} {:>9} {:>13}".format('method', 'lookups', 'statements', 'time (s)', 'lookups/s'))
+    for method_name, method in METHODS:
+        recorder = instrumentation.enable(engine)
+        start = time.time()
+        method(engine, args.threads, food_ids)
+        elapsed = time.time() - start
+        instrumentation.disable()
+        num_statements = sum(stats['round_trips'] for stats in recorder.summary()['statements'])
+        print("{:<8} {:>8} {:>11} {:>9.3f} {:>13.0f}".format(
+            method_name, len(food_ids), num_statements, elapsed, len(food_ids) / elapsed))
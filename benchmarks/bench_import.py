@@ -0,0 +1,64 @@
+# pytest-benchmark suite of the import, run with:
+#
+#   pytest benchmarks/bench_import.py --benchmark-json=import.json
+#
+# Set USDANUTRIENT_BENCH_SCALE to benchmark scaled copies of the release
+# files, and USDANUTRIENT_BENCH_POSTGRESQL_URI to also benchmark PostgreSQL.
+
+import os
+import shutil
+import sys
+import tempfile
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from usdanutrient import benchservice, importservice
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), '../data')
+SCALE = int(os.environ.get('USDANUTRIENT_BENCH_SCALE', '1'))
+
+@pytest.fixture(scope='module')
+def release_dir():
+    if SCALE <= 1:
+        yield os.path.join(DATA_DIR, 'release28')
+        return
+
+    tmp_dir = tempfile.mkdtemp(prefix='usdanutrient-bench-')
+    try:
+        benchservice.generate_scaled_release(os.path.join(DATA_DIR, 'release28'), tmp_dir, SCALE)
+        yield tmp_dir
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+@pytest.fixture(scope='module', params=['sqlite-memory', 'sqlite-file', 'postgresql'])
+def engine(request):
+    tmp_dir = tempfile.mkdtemp(prefix='usdanutrient-bench-')
+    try:
+        uris = dict(benchservice.get_backends(tmp_dir, os.environ.get('USDANUTRIENT_BENCH_POSTGRESQL_URI')))
+        if request.param not in uris:
+            pytest.skip("{} is not available".format(request.param))
+        engine = create_engine(uris[request.param])
+        yield engine
+        engine.dispose()
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+def test_db_import(benchmark, engine, release_dir):
+    session = sessionmaker(bind=engine)()
+    benchmark.pedantic(importservice.db_import, args=(engine, session, release_dir), rounds=3)
+
+def test_db_import_custom(benchmark, engine, release_dir):
+    session = sessionmaker(bind=engine)()
+    importservice.db_import(engine, session, release_dir)
+    benchmark.pedantic(importservice.db_import_custom, args=(engine, session, os.path.join(DATA_DIR, 'custom')),
+                       rounds=3)
+
+@pytest.mark.parametrize('fname', ['FOOD_DES.txt', 'LANGUAL.txt', 'NUT_DATA.txt', 'WEIGHT.txt'])
+def test_iter_file_rows(benchmark, release_dir, fname):
+    full_fname = os.path.join(release_dir, fname)
+    if not os.path.exists(full_fname):
+        pytest.skip("{} is not in the release files".format(fname))
+    table_class, col_order = importservice.get_release_file_spec(fname)
+    benchmark(lambda: sum(1 for row in importservice.iter_file_rows(table_class, full_fname, col_order)))
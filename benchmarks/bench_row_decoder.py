@@ -0,0 +1,88 @@
+#!/bin/env python2
+
+# Compare the precompiled row decoder of importservice with the original
+# per-cell regular expression and type dispatch on the release files.
+
+import argparse
+import os
+import re
+import sys
+import time
+from datetime import date
+from decimal import Decimal
+from sqlalchemy import Boolean, Date, Integer, Numeric
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from usdanutrient import importservice
+
+def legacy_iter_file_rows(table_class, fname, col_order):
+    with open(fname) as f:
+        for line in f:
+            values = line.split('^')
+            row = []
+            for ind in range(len(col_order)):
+                col_name = col_order[ind]
+                col_value = None
+                wrapped_value = values[ind].strip().decode('windows-1252')
+                match = re.match('[~]{0,1}([^~]*)[~]{0,1}', wrapped_value)
+                if match:
+                    col_value = match.group(1)
+
+                if type(table_class.__dict__[col_name].type) is Integer:
+                    if col_value == '':
+                        col_value = None
+                    else:
+                        col_value = int(col_value)
+                elif type(table_class.__dict__[col_name].type) is Numeric:
+                    if col_value == '':
+                        col_value = None
+                    else:
+                        col_value = Decimal(col_value)
+                elif type(table_class.__dict__[col_name].type) is Date:
+                    match_date = re.match('([\d]{2})/([\d]{4})', col_value)
+                    if match_date:
+                        col_value = date(int(match_date.group(2)), int(match_date.group(1)), 1)
+                    else:
+                        col_value = None
+                elif type(table_class.__dict__[col_name].type) is Boolean:
+                    if (col_value.upper() == 'N'
+                            or col_value == '0'
+                            or not col_value):
+                        col_value = False
+                    else:
+                        col_value = True
+
+                row.append(col_value)
+            yield tuple(row)
+
+def best_of(repeat, func, *args):
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        result = list(func(*args))
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description='Benchmark the release file row decoder')
+    arg_parser.add_argument('--data-dir', '-d', dest='data_dir', help='Directory of release files',
+                            default=os.path.join(os.path.dirname(os.path.realpath(__file__)), '../data/release28'))
+    arg_parser.add_argument('--repeat', '-n', dest='repeat', help='Number of timed runs per file', type=int, default=3)
+    args = arg_parser.parse_args()
+
+    print("{:<16} {:>8} {:>10} {:>10} {:>8}".format('file', 'rows', 'legacy (s)', 'decoder (s)', 'speedup'))
+    for fname in sorted(os.listdir(args.data_dir)):
+        table_class, col_order = importservice.get_release_file_spec(fname)
+        if not col_order:
+            continue
+
+        full_fname = os.path.join(args.data_dir, fname)
+        legacy_time, legacy_rows = best_of(args.repeat, legacy_iter_file_rows, table_class, full_fname, col_order)
+        decoder_time, decoder_rows = best_of(args.repeat, importservice.iter_file_rows, table_class, full_fname, col_order)
+        if legacy_rows != decoder_rows:
+            raise ValueError("Decoded rows of '{}' differ from the legacy path".format(fname))
+
+        print("{:<16} {:>8} {:>10.3f} {:>10.3f} {:>7.1f}x".format(
+            fname, len(decoder_rows), legacy_time, decoder_time, legacy_time / decoder_time))
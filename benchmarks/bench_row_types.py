@@ -0,0 +1,78 @@
+#!/bin/env python2
+
+# Compare reading a table through the ORM, i.e. session.query(), with the
+# named tuple rows of queryservice.iter_rows. Each method runs in its own
+# process, so that its peak memory is measured in isolation.
+
+import argparse
+import gc
+import multiprocessing
+import os
+import resource
+import sys
+import time
+import yaml
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from usdanutrient import model, queryservice
+
+def read_orm(engine, table_class):
+    session = sessionmaker(bind=engine)()
+    try:
+        return session.query(table_class).all()
+    finally:
+        session.close()
+
+def read_rows(engine, table_class):
+    return queryservice.get_rows(engine, table_class)
+
+METHODS = [('orm', read_orm), ('rows', read_rows)]
+
+def run_method(uri, table_name, method_name, results):
+    engine = create_engine(uri)
+    table_class = dict((table_class.__name__, table_class) for table_class in [
+        model.Food, model.Nutrient, model.FoodNutrientData, model.Weight, model.FoodLangualMap])[table_name]
+    method = dict(METHODS)[method_name]
+
+    gc.collect()
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.time()
+    rows = method(engine, table_class)
+    elapsed = time.time() - start
+    # ru_maxrss is in kilobytes on Linux
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    results.put((len(rows), elapsed, (rss_after - rss_before) / 1024.0))
+
+def measure(uri, table_name, method_name):
+    results = multiprocessing.Queue()
+    process = multiprocessing.Process(target=run_method, args=(uri, table_name, method_name, results))
+    process.start()
+    result = results.get()
+    process.join()
+    return result
+
+if __name__ == '__main__':
+    config_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), '../conf/usdanutrient.yml')
+    default_uri = None
+    if os.path.exists(config_path):
+        with open(config_path) as f:
+            default_uri = yaml.safe_load(f)['database']['uri']
+
+    arg_parser = argparse.ArgumentParser(description='Benchmark ORM instances against named tuple rows')
+    arg_parser.add_argument('--uri', '-u', dest='uri', help='Database URI of an imported database', default=default_uri)
+    arg_parser.add_argument('--table', '-t', dest='tables', help='Model classes to read', nargs='+',
+                            choices=['Food', 'Nutrient', 'FoodNutrientData', 'Weight', 'FoodLangualMap'],
+                            default=['FoodNutrientData'])
+    args = arg_parser.parse_args()
+    if not args.uri:
+        arg_parser.error('no database URI; pass --uri or create conf/usdanutrient.yml')
+
+    print("{:<18} {:<6} {:>9} {:>9} {:>10} {:>13}".format('table', 'method', 'rows', 'time (s)', 'peak (MB)', 'bytes/row'))
+    for table_name in args.tables:
+        for method_name, method in METHODS:
+            num_rows, elapsed, peak_mb = measure(args.uri, table_name, method_name)
+            print("{:<18} {:<6} {:>9} {:>9.3f} {:>10.1f} {:>13.0f}".format(
+                table_name, method_name, num_rows, elapsed, peak_mb,
+                peak_mb * 1024 * 1024 / num_rows if num_rows else 0))
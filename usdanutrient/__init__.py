@@ -1,2 +1,2 @@
 __version__ = '0.1.0'
-__all__ = ["importservice", "model"]
+__all__ = ["benchservice", "bulkloader", "cacheservice", "engineservice", "facetservice", "fileservice", "importservice", "instrumentation", "loaderservice", "model", "nutrientmatrix", "queryservice", "recipeservice", "searchservice", "similarityservice", "snapshotservice", "statsservice", "validationservice"]
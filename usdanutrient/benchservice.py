@@ -0,0 +1,219 @@
+import Queue
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import tempfile
+import time
+import traceback
+from datetime import datetime
+import sqlalchemy
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+import bulkloader
+import importservice
+
+# Release files whose first field is a food id, which are replicated with
+# new food ids by generate_scaled_release
+FOOD_KEYED_FILES = ('DATSRCLN.txt', 'FOOD_DES.txt', 'FOOTNOTE.txt', 'LANGUAL.txt', 'NUT_DATA.txt', 'WEIGHT.txt')
+
+# Food ids of the Nth copy are offset by N times this value
+SCALE_ID_OFFSET = 100000
+
+def generate_scaled_release(src_dir, dst_dir, scale):
+    # Writes a copy of the release files of src_dir in which every food, and
+    # the rows that reference it, appear scale times. The long description
+    # of each copy is suffixed, since the custom import looks foods up by
+    # long description.
+    max_long_desc = importservice.model.Food.__table__.c.long_desc.type.length
+    for fname in sorted(os.listdir(src_dir)):
+        if not fname.endswith('.txt'):
+            continue
+        src_fname = os.path.join(src_dir, fname)
+        dst_fname = os.path.join(dst_dir, fname)
+        if fname not in FOOD_KEYED_FILES:
+            shutil.copyfile(src_fname, dst_fname)
+            continue
+
+        with open(src_fname, 'rb') as f:
+            lines = f.readlines()
+        with open(dst_fname, 'wb') as f:
+            f.writelines(lines)
+            for copy in range(1, scale):
+                suffix = ' #{}'.format(copy)
+                for line in lines:
+                    values = line.split('^')
+                    values[0] = '~{}~'.format(int(values[0].strip('~')) + copy * SCALE_ID_OFFSET)
+                    if fname == 'FOOD_DES.txt':
+                        long_desc = values[2].strip('~')[:max_long_desc - len(suffix)]
+                        values[2] = '~{}{}~'.format(long_desc, suffix)
+                    f.write('^'.join(values))
+
+def get_peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+def time_release_file(engine, table_class, fname, col_order, batch_size, bulk_load):
+    # Times the stages of loading a release file: splitting its lines and
+    # converting the values, in a first pass that discards the rows, then
+    # inserting and committing the rows, which the loader streams from the
+    # file again. The rows read during the insert are timed as a nested
+    # stage, so that the insert time excludes them. The peak memory is that
+    # of the process so far, so that it shows the tables that raise it.
+    read_timer = bulkloader.StageTimer()
+    num_rows = 0
+    for row in importservice.iter_file_rows(table_class, fname, col_order, read_timer):
+        num_rows += 1
+
+    timer = bulkloader.StageTimer()
+    bulkloader.load_rows(engine, table_class.__table__, col_order,
+                         lambda: importservice.iter_file_rows(table_class, fname, col_order, timer),
+                         batch_size, bulk_load, timer)
+
+    stages = {
+        'parse_s': read_timer.times.get('parse', 0),
+        'convert_s': read_timer.times.get('convert', 0),
+        'insert_s': timer.times.get('insert', 0),
+        'commit_s': timer.times.get('commit', 0),
+    }
+    total_time = sum(stages.values())
+    return dict(stages, rows=num_rows, total_s=total_time,
+                rows_per_s=num_rows / total_time if total_time else None,
+                peak_rss_mb=get_peak_rss_mb())
+
+def run_backend_benchmark(uri, data_dir, custom_data_dir, batch_size, bulk_load):
+    engine = create_engine(uri)
+    try:
+        # Per-stage timings of each table, loaded serially
+        table_classes = importservice.get_model_classes()
+        for table_class in reversed(table_classes):
+            table_class.__table__.drop(engine, checkfirst=True)
+        for table_class in table_classes:
+            table_class.__table__.create(engine)
+
+        tasks = importservice.get_release_file_tasks(data_dir)
+        tables = {}
+        for table_class in table_classes:
+            if table_class.__tablename__ in tasks:
+                table_class, fname, col_order = tasks[table_class.__tablename__]
+                tables[table_class.__tablename__] = time_release_file(
+                    engine, table_class, fname, col_order, batch_size, bulk_load)
+
+        # End-to-end imports
+        session = sessionmaker(bind=engine)()
+        start = time.time()
+        importservice.db_import(engine, session, data_dir, batch_size, bulk_load)
+        import_time = time.time() - start
+        num_rows = sum(table['rows'] for table in tables.values())
+
+        start = time.time()
+        importservice.db_import_custom(engine, session, custom_data_dir, batch_size)
+        import_custom_time = time.time() - start
+        session.close()
+    finally:
+        engine.dispose()
+
+    return {
+        'tables': tables,
+        'db_import_s': import_time,
+        'db_import_rows_per_s': num_rows / import_time if import_time else None,
+        'db_import_custom_s': import_custom_time,
+        'peak_rss_mb': get_peak_rss_mb(),
+    }
+
+def backend_benchmark_worker(uri, data_dir, custom_data_dir, batch_size, bulk_load, results):
+    try:
+        results.put((run_backend_benchmark(uri, data_dir, custom_data_dir, batch_size, bulk_load), None))
+    except Exception:
+        results.put((None, traceback.format_exc()))
+
+def get_worker_result(process, results, backend):
+    # Waits for the result of the benchmark worker process. A worker that
+    # exits without a result, e.g. killed for running out of memory, would
+    # leave a blocking get waiting forever.
+    while True:
+        try:
+            return results.get(timeout=importservice.WORKER_POLL_INTERVAL)
+        except Queue.Empty:
+            if not process.is_alive():
+                break
+    # The result may have been flushed just before the process exited
+    try:
+        return results.get(timeout=importservice.WORKER_POLL_INTERVAL)
+    except Queue.Empty:
+        raise ValueError("Benchmark worker of {} exited with code {} without a result".format(
+            backend, process.exitcode))
+
+def get_backends(tmp_dir, postgresql_uri=None):
+    # Maps the names of the benchmarked backends to their URIs; PostgreSQL
+    # is only included if it accepts connections.
+    backends = [('sqlite-memory', 'sqlite://'),
+                ('sqlite-file', 'sqlite:///' + os.path.join(tmp_dir, 'bench.sqlite'))]
+    if postgresql_uri:
+        engine = create_engine(postgresql_uri)
+        try:
+            engine.connect().close()
+            backends.append(('postgresql', postgresql_uri))
+        except Exception as e:
+            print("Skipping PostgreSQL benchmark: {}".format(e))
+        finally:
+            engine.dispose()
+    return backends
+
+def run_benchmarks(data_dir, custom_data_dir, scale=1, batch_size=importservice.DEFAULT_BATCH_SIZE,
+                   bulk_load=True, postgresql_uri=None):
+    # Benchmarks the import into every backend, each in its own process so
+    # that its peak memory is measured in isolation. Returns the results as
+    # a dict that can be serialized to JSON.
+    tmp_dir = tempfile.mkdtemp(prefix='usdanutrient-bench-')
+    try:
+        if scale > 1:
+            release_dir = os.path.join(tmp_dir, 'release')
+            os.mkdir(release_dir)
+            generate_scaled_release(data_dir, release_dir, scale)
+            data_dir = release_dir
+
+        runs = []
+        for backend, uri in get_backends(tmp_dir, postgresql_uri):
+            print("Benchmarking the import into {}".format(backend))
+            results = multiprocessing.Queue()
+            process = multiprocessing.Process(
+                target=backend_benchmark_worker,
+                args=(uri, data_dir, custom_data_dir, batch_size, bulk_load, results))
+            process.start()
+            try:
+                result, error = get_worker_result(process, results, backend)
+            except:
+                process.terminate()
+                raise
+            finally:
+                process.join()
+            if error:
+                raise ValueError("Unable to benchmark the import into {}:\n{}".format(backend, error))
+            result['backend'] = backend
+            runs.append(result)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    return {
+        'created_at': datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'sqlalchemy': sqlalchemy.__version__,
+        'platform': platform.platform(),
+        'scale': scale,
+        'batch_size': batch_size,
+        'bulk_load': bulk_load,
+        'runs': runs,
+    }
+
+def save_benchmarks(results, fname=None):
+    # Writes the results as JSON to fname, or prints them
+    data = json.dumps(results, indent=2, sort_keys=True)
+    if fname:
+        with open(fname, 'w') as f:
+            f.write(data)
+        print("Saved benchmark results to '{}'".format(fname))
+    else:
+        print(data)
@@ -0,0 +1,261 @@
+import contextlib
+import itertools
+import os
+import tempfile
+import time
+from datetime import date
+
+class BulkLoadUnavailable(Exception):
+    pass
+
+class StageTimer(object):
+    # Accumulates the seconds spent in each named stage of a load, e.g.
+    # 'insert' and 'commit'. Stages may be nested, e.g. the parsing of the
+    # rows that a loader reads while it inserts them, and the time of a
+    # stage excludes that of the stages within it.
+    def __init__(self):
+        self.times = {}
+        self.nested_times = []
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.time()
+        self.nested_times.append(0.0)
+        try:
+            yield
+        finally:
+            elapsed = time.time() - start
+            self.times[name] = self.times.get(name, 0) + elapsed - self.nested_times.pop()
+            if self.nested_times:
+                self.nested_times[-1] += elapsed
+
+    def add(self, name, elapsed):
+        # Records the seconds of a stage that the caller timed itself, e.g.
+        # for every line of a file, within the current stage, if any
+        self.times[name] = self.times.get(name, 0) + elapsed
+        if self.nested_times:
+            self.nested_times[-1] += elapsed
+
+def iter_batches(rows, batch_size):
+    rows = iter(rows)
+    while True:
+        batch = list(itertools.islice(rows, batch_size))
+        if not batch:
+            return
+        yield batch
+
+def get_bind_processors(engine, table, col_order):
+    dialect = engine.dialect
+    return [table.c[col_name].type.dialect_impl(dialect).bind_processor(dialect)
+            for col_name in col_order]
+
+def quote_columns(engine, table, col_order):
+    quote = engine.dialect.identifier_preparer.quote
+    return quote(table.name), ', '.join(quote(col_name) for col_name in col_order)
+
+def escape_text_value(value, true_value, false_value):
+    # Text format shared by PostgreSQL COPY and MySQL LOAD DATA: tab
+    # separated, backslash escaped and \N for NULL.
+    if value is None:
+        return '\\N'
+    elif value is True:
+        return true_value
+    elif value is False:
+        return false_value
+    elif isinstance(value, date):
+        return value.isoformat()
+    elif isinstance(value, float):
+        # str() rounds floats to 12 significant digits in Python 2
+        return repr(value)
+    elif isinstance(value, basestring):
+        return value.\
+            replace('\\', '\\\\').\
+            replace('\t', '\\t').\
+            replace('\n', '\\n').\
+            replace('\r', '\\r')
+    return str(value)
+
+def encode_text_row(row, true_value='t', false_value='f'):
+    line = u'\t'.join(escape_text_value(value, true_value, false_value) for value in row)
+    return (line + u'\n').encode('utf-8')
+
+class IterStream(object):
+    # Minimal read-only file object over an iterator of byte strings, so
+    # that rows can be streamed to COPY without materializing the file.
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buf = b''
+
+    def read(self, size=-1):
+        parts = [self.buf]
+        length = len(self.buf)
+        while size < 0 or length < size:
+            try:
+                chunk = next(self.chunks)
+            except StopIteration:
+                break
+            parts.append(chunk)
+            length += len(chunk)
+
+        data = b''.join(parts)
+        if size < 0:
+            self.buf = b''
+            return data
+        self.buf = data[size:]
+        return data[:size]
+
+    readline = read
+
+def load_generic(engine, table, col_order, rows, batch_size, timer):
+    # Like the native loaders, the whole file is inserted within a single
+    # transaction.
+    insert = table.insert()
+    num_rows = 0
+    with engine.connect() as conn:
+        trans = conn.begin()
+        try:
+            with timer.stage('insert'):
+                for batch in iter_batches(rows, batch_size):
+                    conn.execute(insert, [dict(zip(col_order, row)) for row in batch])
+                    num_rows += len(batch)
+            with timer.stage('commit'):
+                trans.commit()
+        except Exception:
+            trans.rollback()
+            raise
+    return num_rows
+
+def load_sqlite(engine, table, col_order, rows, batch_size, timer):
+    # Inserts batches of batch_size rows with executemany on a raw
+    # connection, in a single transaction. Driver errors roll the whole load
+    # back, so that load_rows can load the rows again with generic inserts.
+    if engine.dialect.paramstyle != 'qmark':
+        raise BulkLoadUnavailable("unsupported paramstyle '{}'".format(engine.dialect.paramstyle))
+
+    table_name, col_names = quote_columns(engine, table, col_order)
+    sql = "INSERT INTO {} ({}) VALUES ({})".format(
+        table_name, col_names, ', '.join('?' * len(col_order)))
+    processors = get_bind_processors(engine, table, col_order)
+    num_rows = 0
+
+    def iter_params(batch):
+        for row in batch:
+            yield tuple([processor(value) if processor else value
+                         for processor, value in zip(processors, row)])
+
+    conn = engine.raw_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("PRAGMA journal_mode")
+        prev_journal_mode = cursor.fetchone()[0]
+        cursor.execute("PRAGMA synchronous")
+        prev_synchronous = cursor.fetchone()[0]
+
+        # Skip the rollback journal and fsyncs for the duration of the load;
+        # the whole file is inserted within a single transaction.
+        cursor.execute("PRAGMA journal_mode = MEMORY")
+        cursor.execute("PRAGMA synchronous = OFF")
+        try:
+            with timer.stage('insert'):
+                for batch in iter_batches(rows, batch_size):
+                    cursor.executemany(sql, iter_params(batch))
+                    num_rows += len(batch)
+            with timer.stage('commit'):
+                conn.commit()
+        except engine.dialect.dbapi.Error as e:
+            conn.rollback()
+            raise BulkLoadUnavailable("executemany failed: {}".format(e))
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            cursor.execute("PRAGMA journal_mode = {}".format(prev_journal_mode))
+            cursor.execute("PRAGMA synchronous = {}".format(prev_synchronous))
+    finally:
+        conn.close()
+
+    return num_rows
+
+def load_postgresql(engine, table, col_order, rows, batch_size, timer):
+    conn = engine.raw_connection()
+    try:
+        cursor = conn.cursor()
+        if not hasattr(cursor, 'copy_expert'):
+            raise BulkLoadUnavailable("driver '{}' does not support COPY".format(engine.dialect.driver))
+
+        table_name, col_names = quote_columns(engine, table, col_order)
+        sql = "COPY {} ({}) FROM STDIN WITH (FORMAT text, ENCODING 'UTF8')".format(table_name, col_names)
+        counter = itertools.count()
+
+        def iter_lines():
+            for row in rows:
+                next(counter)
+                yield encode_text_row(row)
+
+        try:
+            with timer.stage('insert'):
+                cursor.copy_expert(sql, IterStream(iter_lines()))
+            with timer.stage('commit'):
+                conn.commit()
+        except engine.dialect.dbapi.Error as e:
+            conn.rollback()
+            raise BulkLoadUnavailable("COPY failed: {}".format(e))
+    finally:
+        conn.close()
+
+    return next(counter)
+
+def load_mysql(engine, table, col_order, rows, batch_size, timer):
+    # LOAD DATA requires a file, so the rows are spooled to a temporary
+    # file first. The client must be connected with local_infile enabled.
+    fd, fname = tempfile.mkstemp(prefix='usdanutrient-', suffix='.tsv')
+    try:
+        num_rows = 0
+        with timer.stage('insert'):
+            with os.fdopen(fd, 'wb') as f:
+                for row in rows:
+                    f.write(encode_text_row(row, '1', '0'))
+                    num_rows += 1
+
+        table_name, col_names = quote_columns(engine, table, col_order)
+        sql = "LOAD DATA LOCAL INFILE %s INTO TABLE {} CHARACTER SET utf8 ({})".format(table_name, col_names)
+
+        conn = engine.raw_connection()
+        try:
+            cursor = conn.cursor()
+            try:
+                with timer.stage('insert'):
+                    cursor.execute(sql, (fname,))
+                with timer.stage('commit'):
+                    conn.commit()
+            except engine.dialect.dbapi.Error as e:
+                conn.rollback()
+                raise BulkLoadUnavailable("LOAD DATA failed: {}".format(e))
+        finally:
+            conn.close()
+    finally:
+        os.remove(fname)
+
+    return num_rows
+
+BULK_LOADERS = {
+    'mysql': load_mysql,
+    'postgresql': load_postgresql,
+    'sqlite': load_sqlite,
+}
+
+def load_rows(engine, table, col_order, row_source, batch_size, bulk_load=True, timer=None):
+    # row_source returns a fresh iterator of row tuples. A native loader
+    # either succeeds or rolls back before raising BulkLoadUnavailable, in
+    # which case the rows are loaded again with generic inserts. The time
+    # spent inserting and committing the rows is added to timer, if any.
+    if timer is None:
+        timer = StageTimer()
+    loader = BULK_LOADERS.get(engine.dialect.name)
+    if bulk_load and loader:
+        try:
+            return loader(engine, table, col_order, row_source(), batch_size, timer)
+        except BulkLoadUnavailable as e:
+            print("Falling back to generic inserts for table '{}': {}".format(table.name, e))
+
+    return load_generic(engine, table, col_order, row_source(), batch_size, timer)
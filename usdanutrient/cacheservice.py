@@ -0,0 +1,210 @@
+import contextlib
+import threading
+import time
+from collections import OrderedDict
+from multiprocessing.managers import BaseManager
+from sqlalchemy import select
+import instrumentation
+import model
+
+DEFAULT_MAX_SIZE = 10000
+
+# Seconds between the reads of the dataset stamp by a QueryCache; 0 reads
+# it before every lookup outside of a request scope
+DEFAULT_STAMP_INTERVAL = 0
+
+class LRUCache(object):
+    # Bounded mapping that evicts the least recently used entry once it
+    # holds max_size entries, and drops entries older than ttl seconds, if
+    # any. Thread safe, so that it can be served to several processes.
+    def __init__(self, max_size=DEFAULT_MAX_SIZE, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __repr__(self):
+        return "<LRUCache(size='{}', max_size='{}', ttl='{}')>".format(
+            len(self.entries), self.max_size, self.ttl)
+
+    def get(self, key):
+        # Returns (found, value), since None is a valid value
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None and self.ttl is not None and entry[0] + self.ttl < time.time():
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return False, None
+
+            self.entries[key] = entry
+            self.hits += 1
+            return True, entry[1]
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (time.time(), value)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            return {'size': len(self.entries),
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'expirations': self.expirations}
+
+class SharedCacheServer(BaseManager):
+    pass
+
+class SharedCacheClient(BaseManager):
+    pass
+
+_shared_cache = None
+
+def init_shared_cache(max_size, ttl):
+    global _shared_cache
+    _shared_cache = LRUCache(max_size, ttl)
+
+def get_shared_cache():
+    return _shared_cache
+
+SharedCacheServer.register('get_cache', callable=get_shared_cache)
+SharedCacheClient.register('get_cache')
+
+def start_shared_cache(address=('127.0.0.1', 0), authkey=b'usdanutrient', max_size=DEFAULT_MAX_SIZE, ttl=None):
+    # Serves one LRUCache from a separate local process, which stands in
+    # for a shared cache server. Returns the started manager, whose address
+    # the other processes pass to connect_shared_cache.
+    manager = SharedCacheServer(address=address, authkey=authkey)
+    manager.start(init_shared_cache, (max_size, ttl))
+    return manager
+
+def connect_shared_cache(address, authkey=b'usdanutrient'):
+    # Returns a proxy of the shared LRUCache, which QueryCache accepts as
+    # its backend.
+    manager = SharedCacheClient(address=address, authkey=authkey)
+    manager.connect()
+    return manager.get_cache()
+
+def get_dataset_stamp(conn):
+    table = model.DatasetVersion.__table__
+    return conn.execute(select([table.c.stamp]).where(table.c.id == 1)).scalar()
+
+@instrumentation.instrumented
+def query_nutrient_profile(conn, food_id):
+    table = model.FoodNutrientData.__table__
+    return dict(conn.execute(
+        select([table.c.nutrient_id, table.c.value]).where(table.c.food_id == food_id)).fetchall())
+
+@instrumentation.instrumented
+def query_weights(conn, food_id):
+    table = model.Weight.__table__
+    return [dict(row) for row in conn.execute(
+        table.select().where(table.c.food_id == food_id).order_by(table.c.sequence))]
+
+@instrumentation.instrumented
+def query_footnotes(conn, food_id):
+    table = model.Footnote.__table__
+    return [dict(row) for row in conn.execute(
+        table.select().where(table.c.food_id == food_id).order_by(table.c.orig_id))]
+
+@instrumentation.instrumented
+def query_data_sources(conn, food_id):
+    # The data sources of the nutrient values of the food, with the
+    # nutrient_id that each one documents
+    map_table = model.FoodNutrientDataSourceMap.__table__
+    source_table = model.DataSource.__table__
+    query = select([map_table.c.nutrient_id, source_table]).\
+        select_from(map_table.join(source_table, map_table.c.data_source_id == source_table.c.id)).\
+        where(map_table.c.food_id == food_id).\
+        order_by(map_table.c.nutrient_id, source_table.c.id)
+    return [dict(row) for row in conn.execute(query)]
+
+class QueryCache(object):
+    # Read-through cache of the lookups of a food. Results are plain dicts
+    # and lists rather than ORM instances, so that they can be shared by
+    # sessions and processes. Keys include the stamp of the dataset_version
+    # table, which every import replaces, and by default the stamp is read
+    # before every lookup, so results of an earlier import are never
+    # served. The lookups within a request() scope share one read of the
+    # stamp, made when the scope is entered. A stamp_interval greater than
+    # 0 opts into reading it at most once every stamp_interval seconds
+    # instead, which serves results of an earlier import for up to that
+    # long after the next one commits; invalidate() then makes the next
+    # lookup read the stamp, e.g. after an import within the same process.
+    def __init__(self, connectable, backend=None, stamp_interval=DEFAULT_STAMP_INTERVAL):
+        self.connectable = connectable
+        self.backend = backend if backend is not None else LRUCache()
+        self.stamp_interval = stamp_interval
+        self.stamp = None
+        self.stamp_checked_at = None
+        self.local = threading.local()
+
+    def __repr__(self):
+        return "<QueryCache(stamp='{}', backend='{}')>".format(self.stamp, self.backend)
+
+    def get_stamp(self):
+        now = time.time()
+        if self.stamp_checked_at is None or now - self.stamp_checked_at >= self.stamp_interval:
+            stamp = get_dataset_stamp(self.connectable)
+            if self.stamp is not None and stamp != self.stamp:
+                # Free the entries of the previous import right away
+                self.backend.clear()
+            self.stamp = stamp
+            self.stamp_checked_at = now
+        return self.stamp
+
+    def invalidate(self):
+        self.stamp_checked_at = None
+
+    @contextlib.contextmanager
+    def request(self):
+        # Reads the stamp once for the lookups of the thread within the
+        # block, e.g. those of one request of a server, which then all see
+        # the same import. Nested scopes share the stamp of the outermost.
+        if getattr(self.local, 'stamp', None) is not None:
+            yield self
+            return
+        self.local.stamp = self.get_stamp()
+        try:
+            yield self
+        finally:
+            self.local.stamp = None
+
+    def lookup(self, name, query, *args):
+        stamp = getattr(self.local, 'stamp', None)
+        key = (stamp if stamp is not None else self.get_stamp(), name) + args
+        found, value = self.backend.get(key)
+        if not found:
+            value = query(self.connectable, *args)
+            self.backend.set(key, value)
+        return value
+
+    def get_nutrient_profile(self, food_id):
+        # Maps the nutrient ids of the food to their values
+        return self.lookup('nutrient_profile', query_nutrient_profile, food_id)
+
+    def get_weights(self, food_id):
+        return self.lookup('weights', query_weights, food_id)
+
+    def get_footnotes(self, food_id):
+        return self.lookup('footnotes', query_footnotes, food_id)
+
+    def get_data_sources(self, food_id):
+        return self.lookup('data_sources', query_data_sources, food_id)
+
+    def stats(self):
+        return self.backend.stats()
@@ -0,0 +1,283 @@
+import itertools
+import os
+import shutil
+import tempfile
+import threading
+import time
+from sqlalchemy import create_engine, exc
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.orm import Session, sessionmaker
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.sql.expression import CompoundSelect, Select
+
+# Pool settings of usdanutrient.yml and the create_engine arguments that
+# they map to
+POOL_OPTIONS = {
+    'size': 'pool_size',
+    'max_overflow': 'max_overflow',
+    'timeout': 'pool_timeout',
+    'recycle': 'pool_recycle',
+    'pre_ping': 'pool_pre_ping',
+}
+
+class PoolWaitStats(object):
+    # Time spent waiting for connections to be checked out of a pool, which
+    # includes opening new connections. Waits that reach the pool timeout
+    # are counted as timeouts.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.total_wait_s = 0.0
+        self.max_wait_s = 0.0
+
+    def __repr__(self):
+        return "<PoolWaitStats(checkouts='{}', timeouts='{}', total_wait_s='{}')>".format(
+            self.checkouts, self.timeouts, self.total_wait_s)
+
+    def record(self, elapsed, timed_out=False):
+        with self.lock:
+            if timed_out:
+                self.timeouts += 1
+            else:
+                self.checkouts += 1
+            self.total_wait_s += elapsed
+            self.max_wait_s = max(self.max_wait_s, elapsed)
+
+    def merge(self, snapshot):
+        # Adds the stats of a snapshot, e.g. of the pool of a worker process
+        with self.lock:
+            self.checkouts += snapshot['checkouts']
+            self.timeouts += snapshot['timeouts']
+            self.total_wait_s += snapshot['total_wait_s']
+            self.max_wait_s = max(self.max_wait_s, snapshot['max_wait_s'])
+
+    def snapshot(self):
+        with self.lock:
+            return {'checkouts': self.checkouts,
+                    'timeouts': self.timeouts,
+                    'total_wait_s': self.total_wait_s,
+                    'max_wait_s': self.max_wait_s,
+                    'mean_wait_s': self.total_wait_s / self.checkouts if self.checkouts else 0.0}
+
+class MonitoredQueuePool(QueuePool):
+    # QueuePool that records how long each checkout waits. The stats, and
+    # the settings that the engine was configured with, are carried over
+    # when the pool is recreated, e.g. by engine.dispose().
+    def __init__(self, creator, **kwargs):
+        self.wait_stats = PoolWaitStats()
+        self.settings = None
+        QueuePool.__init__(self, creator, **kwargs)
+
+    def _do_get(self):
+        # Every checkout, whether through Engine.connect() or a Session,
+        # goes through _do_get, which blocks while the pool is exhausted
+        start = time.time()
+        try:
+            record = QueuePool._do_get(self)
+        except exc.TimeoutError:
+            self.wait_stats.record(time.time() - start, timed_out=True)
+            raise
+        self.wait_stats.record(time.time() - start)
+        return record
+
+    def recreate(self):
+        pool = QueuePool.recreate(self)
+        pool.wait_stats = self.wait_stats
+        pool.settings = self.settings
+        return pool
+
+def is_sqlite_memory(url):
+    return url.get_backend_name() == 'sqlite' and url.database in (None, '', ':memory:')
+
+def create_configured_engine(settings):
+    # Creates an engine from a section of usdanutrient.yml, either a URI or
+    # a mapping with a uri and optional pool settings. File databases use a
+    # MonitoredQueuePool, including SQLite ones, whose connections are then
+    # allowed to move between threads; in-memory SQLite databases keep
+    # their default single connection pool, and ignore the pool settings.
+    if not isinstance(settings, dict):
+        settings = {'uri': settings}
+    url = make_url(settings['uri'])
+    pool_settings = settings.get('pool') or {}
+    unknown = set(pool_settings) - set(POOL_OPTIONS)
+    if unknown:
+        raise ValueError("Unknown pool settings '{}' for '{}'".format("', '".join(sorted(unknown)), url))
+
+    if is_sqlite_memory(url):
+        return create_engine(url)
+
+    kwargs = dict((POOL_OPTIONS[name], value) for name, value in pool_settings.items())
+    kwargs['poolclass'] = MonitoredQueuePool
+    if url.get_backend_name() == 'sqlite':
+        kwargs['connect_args'] = {'check_same_thread': False}
+    engine = create_engine(url, **kwargs)
+    engine.pool.settings = {'uri': settings['uri'], 'pool': dict(pool_settings)}
+    return engine
+
+def get_wait_stats(engine):
+    # The PoolWaitStats of the engine, or None if its pool is not monitored
+    return getattr(engine.pool, 'wait_stats', None)
+
+def get_engine_settings(engine):
+    # The settings of create_configured_engine that create a copy of the
+    # engine, e.g. in a worker process; engines created otherwise are
+    # copied with the default pool settings
+    settings = getattr(engine.pool, 'settings', None)
+    if settings is None:
+        return {'uri': engine.url}
+    return settings
+
+class RoutingSession(Session):
+    # Session that executes SELECT statements, including those of ORM
+    # queries, on the replica engine that it was created with, if any, and
+    # flushes and executes every other statement, e.g. INSERT, UPDATE,
+    # DELETE, text and SELECT ... FOR UPDATE, on the primary engine. Once
+    # the session has used the primary for anything but a read, it reads
+    # from the primary, so that it sees its own writes until the
+    # transaction ends.
+    def __init__(self, primary=None, replica=None, **kwargs):
+        Session.__init__(self, **kwargs)
+        self.primary = primary
+        self.replica = replica
+        self.wrote = False
+
+    def get_bind(self, mapper=None, clause=None):
+        if self.replica is None:
+            return self.primary
+        is_read = (not self._flushing and isinstance(clause, (Select, CompoundSelect))
+                   and getattr(clause, '_for_update_arg', None) is None)
+        if not is_read:
+            self.wrote = True
+        if self.wrote:
+            return self.primary
+        return self.replica
+
+    def use_primary(self):
+        # Reads from the primary for the rest of the transaction
+        self.wrote = True
+
+    def commit(self):
+        Session.commit(self)
+        self.wrote = False
+
+    def rollback(self):
+        Session.rollback(self)
+        self.wrote = False
+
+class DatabaseRouter(object):
+    # Engines of the database section of usdanutrient.yml: the primary, the
+    # bulk engine of the release file loads, which defaults to the primary,
+    # and the read-only replicas. Replicas are handed out round-robin.
+    def __init__(self, primary, bulk=None, replicas=()):
+        self.primary = primary
+        self.bulk = bulk if bulk is not None else primary
+        self.replicas = list(replicas)
+        self.lock = threading.Lock()
+        self.replica_cycle = itertools.cycle(self.replicas) if self.replicas else None
+        self.session_factory = sessionmaker(class_=RoutingSession)
+
+    def __repr__(self):
+        return "<DatabaseRouter(primary='{}', bulk='{}', replicas='{}')>".format(
+            self.primary.url, self.bulk.url, len(self.replicas))
+
+    @property
+    def engines(self):
+        # Every distinct engine of the router
+        engines = []
+        for engine in [self.primary, self.bulk] + self.replicas:
+            if engine not in engines:
+                engines.append(engine)
+        return engines
+
+    def get_read_engine(self):
+        # The next replica, or the primary if there are none
+        if self.replica_cycle is None:
+            return self.primary
+        with self.lock:
+            return next(self.replica_cycle)
+
+    def session(self, read_from_replicas=True, **kwargs):
+        # A RoutingSession that writes to the primary and reads from the
+        # next replica, or also from the primary
+        replica = self.get_read_engine() if read_from_replicas and self.replicas else None
+        return self.session_factory(primary=self.primary, replica=replica, **kwargs)
+
+    def pool_stats(self):
+        # Maps the name of each monitored engine to its checkout wait stats
+        stats = {}
+        for name, engine in self.get_named_engines():
+            wait_stats = get_wait_stats(engine)
+            if wait_stats is not None:
+                stats[name] = dict(wait_stats.snapshot(), url=repr(engine.url))
+        return stats
+
+    def get_named_engines(self):
+        names = [('primary', self.primary)]
+        if self.bulk is not self.primary:
+            names.append(('bulk', self.bulk))
+        names.extend(('replica{}'.format(ind), engine) for ind, engine in enumerate(self.replicas))
+        return names
+
+    def dispose(self):
+        for engine in self.engines:
+            engine.dispose()
+
+def create_router(config):
+    # Creates the DatabaseRouter of the database section of usdanutrient.yml:
+    #
+    # database:
+    #     uri: 'postgresql://primary/usda'
+    #     pool: {size: 5, max_overflow: 10, timeout: 30, recycle: 3600, pre_ping: true}
+    #     bulk:
+    #         pool: {size: 1, max_overflow: 0}
+    #     replicas:
+    #         - 'postgresql://replica1/usda'
+    #         - uri: 'postgresql://replica2/usda'
+    #           pool: {size: 10}
+    #
+    # The bulk engine defaults to the URI of the primary, and replicas to
+    # the pool settings of the primary.
+    database = config['database']
+    pool_settings = database.get('pool') or {}
+    primary = create_configured_engine({'uri': database['uri'], 'pool': pool_settings})
+
+    bulk = None
+    if database.get('bulk'):
+        bulk_settings = dict(database['bulk'])
+        bulk_settings.setdefault('uri', database['uri'])
+        bulk = create_configured_engine(bulk_settings)
+
+    replicas = []
+    for replica_settings in database.get('replicas') or []:
+        if not isinstance(replica_settings, dict):
+            replica_settings = {'uri': replica_settings}
+        replica_settings = dict(replica_settings)
+        replica_settings.setdefault('pool', pool_settings)
+        replicas.append(create_configured_engine(replica_settings))
+    return DatabaseRouter(primary, bulk, replicas)
+
+def sync_sqlite_replicas(router):
+    # Replaces each replica with a copy of the primary, so that SQLite files
+    # can stand in for the replicas of a database server. Each copy is
+    # written to a temporary file, with the mode of the primary, that then
+    # replaces the replica file.
+    if router.primary.url.get_backend_name() != 'sqlite' or is_sqlite_memory(router.primary.url):
+        raise ValueError("Only the replicas of a SQLite file database can be synced; "
+                         "other databases replicate themselves")
+    router.dispose()
+    for replica in router.replicas:
+        if replica.url.get_backend_name() != 'sqlite' or is_sqlite_memory(replica.url):
+            raise ValueError("Replica '{}' is not a SQLite file".format(replica.url))
+        fname = os.path.abspath(replica.url.database)
+        fd, tmp_fname = tempfile.mkstemp(prefix='.replica-', dir=os.path.dirname(fname))
+        os.close(fd)
+        try:
+            shutil.copyfile(router.primary.url.database, tmp_fname)
+            # mkstemp creates the file for its owner only
+            shutil.copymode(router.primary.url.database, tmp_fname)
+            os.rename(tmp_fname, fname)
+        except:
+            os.remove(tmp_fname)
+            raise
+        print("Synced replica '{}'".format(fname))
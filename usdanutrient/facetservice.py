@@ -0,0 +1,177 @@
+import bisect
+import cPickle
+import os
+import re
+import tempfile
+import zlib
+from sqlalchemy import select
+import fileservice
+import model
+
+INDEX_VERSION = 1
+
+QUERY_TOKEN_RE = re.compile(r'\(|\)|[^\s()]+')
+
+class LangualFacetIndex(object):
+    # One bitset per LanguaL descriptor over the food id space: bit N of
+    # bitsets[langual_id] is set if the food food_ids[N] is described by
+    # the descriptor. Bitsets are Python integers, so that boolean queries
+    # are single integer operations over all the foods.
+    def __init__(self, food_ids, bitsets):
+        self.food_ids = food_ids
+        self.bitsets = bitsets
+        self.all_foods = (1 << len(food_ids)) - 1
+
+    def __repr__(self):
+        return "<LangualFacetIndex(foods='{}', facets='{}')>".format(
+            len(self.food_ids), len(self.bitsets))
+
+    def get(self, langual_id):
+        # Unknown descriptors match no foods
+        return self.bitsets.get(langual_id.upper(), 0)
+
+    def all_of(self, langual_ids):
+        bits = self.all_foods
+        for langual_id in langual_ids:
+            bits &= self.get(langual_id)
+        return bits
+
+    def any_of(self, langual_ids):
+        bits = 0
+        for langual_id in langual_ids:
+            bits |= self.get(langual_id)
+        return bits
+
+    def none_of(self, langual_ids):
+        return self.all_foods & ~self.any_of(langual_ids)
+
+    def query(self, expression):
+        # Evaluates a boolean expression of descriptors, e.g.
+        # "A0113 AND NOT (B1234 OR B1235)". Adjacent descriptors without an
+        # operator are ANDed, and NOT binds tighter than AND, than OR.
+        tokens = QUERY_TOKEN_RE.findall(expression)
+        bits, pos = self.parse_or(tokens, 0)
+        if pos != len(tokens):
+            raise ValueError("Unexpected '{}' in LanguaL query: {}".format(tokens[pos], expression))
+        return bits
+
+    def parse_or(self, tokens, pos):
+        bits, pos = self.parse_and(tokens, pos)
+        while pos < len(tokens) and tokens[pos].upper() == 'OR':
+            right, pos = self.parse_and(tokens, pos + 1)
+            bits |= right
+        return bits, pos
+
+    def parse_and(self, tokens, pos):
+        bits, pos = self.parse_not(tokens, pos)
+        while pos < len(tokens) and tokens[pos].upper() != 'OR' and tokens[pos] != ')':
+            if tokens[pos].upper() == 'AND':
+                pos += 1
+            right, pos = self.parse_not(tokens, pos)
+            bits &= right
+        return bits, pos
+
+    def parse_not(self, tokens, pos):
+        if pos >= len(tokens):
+            raise ValueError("Unexpected end of LanguaL query")
+        token = tokens[pos]
+        if token.upper() == 'NOT':
+            bits, pos = self.parse_not(tokens, pos + 1)
+            return self.all_foods & ~bits, pos
+        if token == '(':
+            bits, pos = self.parse_or(tokens, pos + 1)
+            if pos >= len(tokens) or tokens[pos] != ')':
+                raise ValueError("Missing ')' in LanguaL query")
+            return bits, pos + 1
+        if token == ')' or token.upper() in ('AND', 'OR'):
+            raise ValueError("Unexpected '{}' in LanguaL query".format(token))
+        return self.get(token), pos + 1
+
+    @staticmethod
+    def count(bits):
+        return bin(bits).count('1')
+
+    def get_food_ids(self, bits):
+        # The ids of the foods of the bitset, in ascending order
+        food_ids = []
+        digits = bin(bits)[:1:-1]
+        pos = digits.find('1')
+        while pos >= 0:
+            food_ids.append(self.food_ids[pos])
+            pos = digits.find('1', pos + 1)
+        return food_ids
+
+    def get_bits(self, food_ids):
+        bits = 0
+        for food_id in food_ids:
+            pos = bisect.bisect_left(self.food_ids, food_id)
+            if pos < len(self.food_ids) and self.food_ids[pos] == food_id:
+                bits |= 1 << pos
+        return bits
+
+    def facet_counts(self, bits=None):
+        # Maps every descriptor to the number of foods of the bitset, by
+        # default all the foods, that it describes; descriptors without
+        # foods are left out.
+        counts = {}
+        for langual_id, facet_bits in self.bitsets.items():
+            if bits is not None:
+                facet_bits &= bits
+            if facet_bits:
+                counts[langual_id] = self.count(facet_bits)
+        return counts
+
+    def save(self, path):
+        # The bitsets are saved as zlib compressed hexadecimal strings. The
+        # index is written to a temporary file that then replaces path, so
+        # readers never see a partial index.
+        bitsets = dict((langual_id, zlib.compress('{:x}'.format(bits)))
+                       for langual_id, bits in self.bitsets.items())
+        fd, tmp_path = tempfile.mkstemp(prefix='.langualindex-', dir=os.path.dirname(os.path.abspath(path)))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                cPickle.dump((INDEX_VERSION, self.food_ids, bitsets), f, cPickle.HIGHEST_PROTOCOL)
+            # mkstemp creates the file for its owner only
+            os.chmod(tmp_path, 0o666 & ~fileservice.get_umask())
+            os.rename(tmp_path, path)
+        except:
+            os.remove(tmp_path)
+            raise
+
+def load_facet_index(path):
+    with open(path, 'rb') as f:
+        data = cPickle.load(f)
+    if data[0] != INDEX_VERSION:
+        raise ValueError("Unsupported LanguaL index version '{}' in '{}'".format(data[0], path))
+
+    version, food_ids, bitsets = data
+    return LangualFacetIndex(food_ids, dict((langual_id, int(zlib.decompress(bits), 16))
+                                            for langual_id, bits in bitsets.items()))
+
+def build_facet_index(connectable):
+    food_table = model.Food.__table__
+    map_table = model.FoodLangualMap.__table__
+
+    food_ids = [row[0] for row in connectable.execute(select([food_table.c.id]).order_by(food_table.c.id))]
+    positions = dict((food_id, pos) for pos, food_id in enumerate(food_ids))
+
+    # The bits of each descriptor are collected before the bitset is built,
+    # since setting one bit at a time copies the whole integer.
+    facet_positions = {}
+    for food_id, langual_id in connectable.execute(select([map_table.c.food_id, map_table.c.langual_id])):
+        if food_id in positions:
+            facet_positions.setdefault(langual_id, []).append(positions[food_id])
+
+    bitsets = {}
+    for langual_id, facet_pos in facet_positions.items():
+        digits = ['0'] * len(food_ids)
+        for pos in facet_pos:
+            digits[pos] = '1'
+        bitsets[langual_id] = int(''.join(reversed(digits)) or '0', 2)
+    return LangualFacetIndex(food_ids, bitsets)
+
+def update_facet_index(connectable, path):
+    index = build_facet_index(connectable)
+    index.save(path)
+    print("Saved {} to '{}'".format(index, path))
+    return index
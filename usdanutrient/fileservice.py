@@ -0,0 +1,48 @@
+import os
+import shutil
+import tempfile
+
+def get_umask():
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+def make_version_dir(path):
+    # A new directory next to path, for the next version of its contents.
+    # mkdtemp creates it for its owner only; it gets the mode of a
+    # directory created by mkdir, so that processes of other users can
+    # read the versions through the link.
+    parent = os.path.dirname(os.path.abspath(path))
+    version_path = tempfile.mkdtemp(prefix='.{}-'.format(os.path.basename(os.path.abspath(path))), dir=parent)
+    os.chmod(version_path, 0o777 & ~get_umask())
+    return version_path
+
+def replace_dir(tmp_path, path):
+    # Makes path a symlink to tmp_path, a directory of make_version_dir. The
+    # link is replaced by renaming a new link over it, so that readers find
+    # either the previous version or the new one, never a missing or partial
+    # one. The previous version is kept for the readers that have just
+    # resolved the link, and older ones are removed; processes that have
+    # their files open or mapped keep them. A path that is still a plain
+    # directory, saved by an earlier version, is moved aside first, which
+    # may fail the readers that are loading it at that moment, once.
+    parent = os.path.dirname(os.path.abspath(path))
+    link_path = tmp_path + '.link'
+    os.symlink(os.path.basename(tmp_path), link_path)
+    try:
+        if os.path.isdir(path) and not os.path.islink(path):
+            prev_path = make_version_dir(path)
+            os.rename(path, prev_path)
+        else:
+            prev_path = os.path.realpath(path)
+        os.rename(link_path, path)
+    except:
+        os.remove(link_path)
+        raise
+
+    prefix = '.{}-'.format(os.path.basename(os.path.abspath(path)))
+    for name in os.listdir(parent):
+        version_path = os.path.join(parent, name)
+        if (name.startswith(prefix) and os.path.isdir(version_path) and not os.path.islink(version_path)
+                and version_path not in (tmp_path, prev_path)):
+            shutil.rmtree(version_path, ignore_errors=True)
@@ -1,87 +1,278 @@
+import hashlib
 import inspect
+import io
+import multiprocessing
 import os
-import re
 import sys
 import csv
+import time
+import traceback
+import uuid
 import sqlalchemy.orm.exc
-from sqlalchemy.orm.session import make_transient
-from sqlalchemy import and_, Boolean, Date, func, Integer, Numeric
-from datetime import date
+from multiprocessing.pool import ThreadPool
+from sqlalchemy import (and_, bindparam, literal, select, type_coerce, Boolean, Column, Date, Float,
+                        Integer, MetaData, Numeric, Table)
+from sqlalchemy.schema import AddConstraint, CreateIndex, CreateTable, sort_tables
+from collections import OrderedDict
+from datetime import date, datetime
 from decimal import Decimal
+import bulkloader
+import engineservice
+import instrumentation
 import model
+import statsservice
 
-def db_import_file(engine, table_class, fname, col_order):
-    with open(fname) as f:
-        rows = []
-        for line in f:
+DEFAULT_BATCH_SIZE = 10000
+
+# Backends that can add primary and foreign keys to existing tables
+DEFERRED_INDEX_DIALECTS = ('mysql', 'postgresql')
+
+# Maximum number of values in the IN clause of a lookup query
+LOOKUP_CHUNK_SIZE = 500
+
+# Seconds between the checks of the results of the parallel import workers
+WORKER_POLL_INTERVAL = 0.1
+
+# Custom files, in the order that they are applied
+CUSTOM_IMPORT_ORDER = ['local_food.csv', 'local_food_weight.csv', 'local_food_weight_alias.csv',
+                       'nutrient_category.csv', 'nutrient_category_map.csv',
+                       'local_food_nutrient_data.csv', 'local_food_nutrient_data_alias.csv']
+
+def convert_integer(value):
+    if value == '':
+        return None
+    return int(value)
+
+def convert_numeric(value):
+    if value == '':
+        return None
+    return Decimal(value)
+
+def convert_date(value):
+    # Dates are formatted as MM/YYYY
+    if len(value) >= 7 and value[2] == '/' and value[:2].isdigit() and value[3:7].isdigit():
+        return date(int(value[3:7]), int(value[:2]), 1)
+    return None
+
+def convert_boolean(value):
+    return not (value.upper() == 'N'
+                or value == '0'
+                or not value)
+
+def convert_string(value):
+    return value
+
+COLUMN_CONVERTERS = {
+    Integer: convert_integer,
+    Numeric: convert_numeric,
+    Date: convert_date,
+    Boolean: convert_boolean,
+}
+
+_row_decoders = {}
+
+def get_row_decoder(table_class, col_order):
+    # Resolve the converter of every column once, rather than for every
+    # cell of every line.
+    key = (table_class, tuple(col_order))
+    decoder = _row_decoders.get(key)
+    if decoder is None:
+        converters = [COLUMN_CONVERTERS.get(type(table_class.__table__.c[col_name].type), convert_string)
+                      for col_name in col_order]
+        num_cols = len(converters)
+
+        def split(line):
             values = line.split('^')
-            row = {}
-            for ind in range(len(col_order)):
-                col_name = col_order[ind]
-                col_value = None
-                wrapped_value = values[ind].strip().decode('windows-1252')
-                match = re.match('[~]{0,1}([^~]*)[~]{0,1}', wrapped_value)
-                if match:
-                    col_value = match.group(1)
-                else:
-                    if len(wrapped_value):
-                        raise ValueError(
-                            "Unexpected value, '{}'; regular expression did not match line:\n{}.".format(
-                                wrapped_value, line))
-
-                if type(table_class.__dict__[col_name].type) is Integer:
-                    if col_value == '':
-                        col_value = None
-                    else:
-                        col_value = int(col_value)
-                elif type(table_class.__dict__[col_name].type) is Numeric:
-                    if col_value == '':
-                        col_value = None
-                    else:
-                        col_value = Decimal(col_value)
-                elif type(table_class.__dict__[col_name].type) is Date:
-                    match_date = re.match('([\d]{2})/([\d]{4})', col_value)
-                    if match_date:
-                        month = match_date.group(1)
-                        year = match_date.group(2)
-                        col_value = date(int(year), int(month), 1)
-                    else:
-                        col_value = None
-                elif type(table_class.__dict__[col_name].type) is Boolean:
-                    if (col_value.upper() == 'N'
-                            or col_value == '0'
-                            or not col_value):
-                        col_value = False
-                    else:
-                        col_value = True
-
-                row[col_name] = col_value
-            rows.append(row)
-
-        engine.execute(table_class.__table__.insert(), rows)
+            if len(values) < num_cols:
+                raise ValueError("Expected {} values for table '{}'; found {} in line:\n{}".format(
+                    num_cols, table_class.__tablename__, len(values), line))
+            return values
+
+        def convert_values(values):
+            # Text values are wrapped in tildes
+            return tuple([convert(value.strip().strip('~'))
+                          for convert, value in zip(converters, values)])
+
+        # The steps are also exposed separately, for timing them
+        def decoder(line):
+            return convert_values(split(line))
+
+        decoder.split = split
+        decoder.convert = convert_values
+        _row_decoders[key] = decoder
+    return decoder
+
+def iter_file_rows(table_class, fname, col_order, timer=None):
+    # With a timer, the time spent splitting the lines and converting the
+    # values is added to its 'parse' and 'convert' stages.
+    decoder = get_row_decoder(table_class, col_order)
+    with io.open(fname, encoding='windows-1252', newline='\n') as f:
+        if timer is None:
+            for line in f:
+                yield decoder(line)
+        else:
+            for row in iter_timed_rows(decoder, f, timer):
+                yield row
+
+def iter_timed_rows(decoder, lines, timer):
+    # Rows are usually read within the 'insert' stage of a loader, which
+    # then excludes their parse and convert time.
+    split = decoder.split
+    convert = decoder.convert
+    for line in lines:
+        start = time.time()
+        values = split(line)
+        split_at = time.time()
+        row = convert(values)
+        end = time.time()
+        timer.add('parse', split_at - start)
+        timer.add('convert', end - split_at)
+        yield row
+
+def db_import_file(engine, table_class, fname, col_order, batch_size=DEFAULT_BATCH_SIZE,
+                   bulk_load=True, timer=None):
+    # Stream the file in fixed-size batches so that peak memory does not
+    # grow with the size of the file.
+    start = time.time()
+    recorder = instrumentation.get_recorder()
+    if recorder is not None and timer is None:
+        timer = bulkloader.StageTimer()
+    file_timer = timer if recorder is not None else None
+    with instrumentation.scope('db_import_file[{}]'.format(table_class.__tablename__)):
+        num_rows = bulkloader.load_rows(
+            engine, table_class.__table__, col_order,
+            lambda: iter_file_rows(table_class, fname, col_order, file_timer),
+            batch_size, bulk_load, timer)
+    if recorder is not None:
+        times = timer.times
+        times['write'] = times.get('insert', 0) + times.get('commit', 0)
+        recorder.record_stages(table_class.__tablename__, num_rows, times)
+
+    elapsed = time.time() - start
+    print("Loaded {} rows into '{}' in {:.2f}s ({:.0f} rows/s)".format(
+        num_rows, table_class.__tablename__, elapsed, num_rows / elapsed if elapsed else 0))
+    return num_rows
+
+class LookupCache(object):
+    # Identity cache of the ids of foods by long_desc, nutrients by name and
+    # food groups by name, shared by the custom import callbacks. Each
+    # lookup is loaded with a single query on first use and kept in sync
+    # as foods are inserted and deleted. Like Query.one(), the getters
+    # raise NoResultFound or MultipleResultsFound.
+    def __init__(self, session):
+        self.session = session
+        self.food_ids = None
+        self.nutrient_ids = None
+        self.food_group_ids = None
+        self.weights = None
+
+    @staticmethod
+    def normalize(name):
+        if isinstance(name, str):
+            return name.decode('utf-8')
+        return name
+
+    @classmethod
+    def load_ids(cls, query, ids=None):
+        if ids is None:
+            ids = {}
+        for name, id in query:
+            ids.setdefault(cls.normalize(name), []).append(id)
+        return ids
+
+    @classmethod
+    def get_id(cls, ids, name):
+        matches = ids.get(cls.normalize(name))
+        if not matches:
+            raise sqlalchemy.orm.exc.NoResultFound()
+        if len(matches) > 1:
+            raise sqlalchemy.orm.exc.MultipleResultsFound()
+        return matches[0]
+
+    def get_food_id(self, long_desc):
+        if self.food_ids is None:
+            self.food_ids = self.load_ids(
+                self.session.query(model.Food.long_desc, model.Food.id))
+        return self.get_id(self.food_ids, long_desc)
+
+    def get_nutrient_id(self, name):
+        if self.nutrient_ids is None:
+            self.nutrient_ids = self.load_ids(
+                self.session.query(model.Nutrient.name, model.Nutrient.id))
+        return self.get_id(self.nutrient_ids, name)
+
+    def get_food_group_id(self, name):
+        if self.food_group_ids is None:
+            self.food_group_ids = self.load_ids(
+                self.session.query(model.FoodGroup.name, model.FoodGroup.id))
+        return self.get_id(self.food_group_ids, name)
+
+    def get_weights(self, food_id):
+        # The weights of the food as a list of row dicts, including the
+        # weights inserted by the current run.
+        if self.weights is None:
+            self.weights = {}
+            table = model.Weight.__table__
+            for row in self.session.execute(table.select()):
+                self.weights.setdefault(row['food_id'], []).append(dict(row))
+        return self.weights.setdefault(food_id, [])
 
+    def add_foods(self, long_descs):
+        # Look up the ids assigned to newly inserted foods
+        if self.food_ids is None:
+            return
+        long_descs = list(set(self.normalize(long_desc) for long_desc in long_descs))
+        for long_desc in long_descs:
+            self.food_ids.pop(long_desc, None)
+        for ind in range(0, len(long_descs), LOOKUP_CHUNK_SIZE):
+            self.load_ids(
+                self.session.\
+                    query(model.Food.long_desc, model.Food.id).\
+                    filter(model.Food.long_desc.in_(long_descs[ind:ind + LOOKUP_CHUNK_SIZE])),
+                self.food_ids)
+
+    def remove_food(self, long_desc):
+        if self.food_ids is not None:
+            for food_id in self.food_ids.pop(self.normalize(long_desc), []):
+                if self.weights is not None:
+                    self.weights.pop(food_id, None)
+
+    def set_nutrient_ids(self, nutrient_ids):
+        self.nutrient_ids = nutrient_ids
+
+@instrumentation.instrumented
 def db_import_custom_file(processing_callback, callback_args):
     fname = callback_args['fname']
-    engine = callback_args['engine']
+    session = callback_args['session']
     table_class = callback_args['table_class']
-    bulk = callback_args['bulk']
+    batch_size = callback_args['batch_size']
+    row_key = callback_args.get('row_key')
+    delete_callback = callback_args.get('delete_callback')
+    callback_args['delete_keys'] = []
 
     print("Processing file '{}'".format(fname))
 
     with open(fname) as f:
         csvreader = csv.reader(f, delimiter='|')
-        rows_out = []
-        for row_in in csvreader:
+        # A row replaces any earlier row of the file with the same key
+        rows_out = OrderedDict()
+        for ind, row_in in enumerate(csvreader):
             row_out = processing_callback(row_in, callback_args)
             if row_out:
-                rows_out.append(row_out)
-                if not bulk:
-                    engine.execute(table_class.__table__.insert(), rows_out)
-                    rows_out = []
+                rows_out[row_key(row_out) if row_key else ind] = row_out
+
+    # The callbacks only collect the keys of the rows to delete, which are
+    # then deleted together before the rows are inserted.
+    if delete_callback and callback_args['delete_keys']:
+        delete_callback(session, callback_args['delete_keys'])
 
-        if bulk and rows_out:
-            engine.execute(table_class.__table__.insert(), rows_out)
+    for batch in bulkloader.iter_batches(rows_out.values(), batch_size):
+        session.execute(table_class.__table__.insert(), batch)
 
+    if table_class is model.Food and rows_out:
+        callback_args['cache'].add_foods(row_out['long_desc'] for row_out in rows_out.values())
+
+@instrumentation.instrumented
 def process_row_generic(row_in, args):
     row_out = {}
     col_order = args['col_order']
@@ -107,317 +298,772 @@ def process_row_generic(row_in, args):
 
     return row_out
 
+def delete_foods(session, long_descs):
+    # Delete the foods along with the rows that the Food relationships
+    # cascade deletes to, with one statement per table.
+    food_table = model.Food.__table__
+    child_tables = [rel.mapper.class_.__table__ for rel in model.Food.__mapper__.relationships
+                    if rel.cascade.delete]
+    long_descs = list(set(long_descs))
+    for ind in range(0, len(long_descs), LOOKUP_CHUNK_SIZE):
+        matches = food_table.c.long_desc.in_(long_descs[ind:ind + LOOKUP_CHUNK_SIZE])
+        food_ids = select([food_table.c.id]).where(matches)
+        for child_table in child_tables:
+            session.execute(child_table.delete().where(child_table.c.food_id.in_(food_ids)))
+        session.execute(food_table.delete().where(matches))
+
+def delete_weights(session, keys):
+    table = model.Weight.__table__
+    session.execute(
+        table.delete().where(and_(
+            table.c.food_id == bindparam('key_food_id'),
+            table.c.measurement_desc == bindparam('key_measurement_desc'),
+        )),
+        [{'key_food_id': food_id, 'key_measurement_desc': measurement_desc}
+         for food_id, measurement_desc in set(keys)])
+
+def get_weight_key(row_out):
+    return row_out['food_id'], row_out['measurement_desc']
+
+def replace_weight(args, food_id, measurement_desc):
+    # Remove the weights of the food with the measurement description and
+    # return the sequence of the new weight, following the remaining ones.
+    weights = args['cache'].get_weights(food_id)
+    weights[:] = [weight for weight in weights if weight['measurement_desc'] != measurement_desc]
+    args['delete_keys'].append((food_id, measurement_desc))
+
+    prev_sequence = max([int(weight['sequence']) for weight in weights] or [0])
+    return prev_sequence + 1
+
+@instrumentation.instrumented
 def process_row_local_food(row_in, args):
-    session = args['session']
+    cache = args['cache']
     result = None
 
-    foods = session.\
-            query(model.Food).\
-            filter(model.Food.long_desc == row_in[0])
-    for food in foods:
-        session.delete(food)
-    session.commit()
-
-    food_group = session.\
-        query(model.FoodGroup).\
-        filter(model.FoodGroup.name == row_in[3]).\
-        one()
+    args['delete_keys'].append(row_in[0])
+    cache.remove_food(row_in[0])
 
     result = {
         'long_desc': row_in[0],
         'short_desc': row_in[1],
         'manufacturer': row_in[2],
-        'group_id': food_group.id,
+        'group_id': cache.get_food_group_id(row_in[3]),
         'refuse_pct': row_in[4]
     }
     return result
 
+@instrumentation.instrumented
 def process_row_local_food_weight(row_in, args):
-    session = args['session']
-
-    food = session.\
-            query(model.Food).\
-            filter(model.Food.long_desc == row_in[0]).\
-            one()
-
-    session.\
-            query(model.Weight).\
-            filter(and_(
-                model.Weight.food_id == food.id,
-                model.Weight.measurement_desc == row_in[2],
-            )).\
-            delete()
-    session.commit()
-
-    prev_sequence = session.\
-            query(func.max(model.Weight.sequence)).\
-            filter(model.Weight.food_id == food.id).\
-            scalar()
-
-    sequence = 1
-    if prev_sequence:
-        sequence = int(prev_sequence) + 1
+    food_id = args['cache'].get_food_id(row_in[0])
+    sequence = replace_weight(args, food_id, row_in[2])
 
-    return {
-        'food_id': food.id,
+    result = {
+        'food_id': food_id,
         'sequence': sequence,
         'amount': row_in[1],
         'measurement_desc': row_in[2],
         'grams': row_in[3]
     }
+    args['cache'].get_weights(food_id).append(result)
+    return result
 
+@instrumentation.instrumented
 def process_row_local_food_weight_alias(row_in, args):
-    session = args['session']
+    cache = args['cache']
+    food_id = cache.get_food_id(row_in[0])
+    sequence = replace_weight(args, food_id, row_in[2])
 
-    food = session.\
-            query(model.Food).\
-            filter(model.Food.long_desc == row_in[0]).\
-            one()
-
-    session.\
-            query(model.Weight).\
-            filter(and_(
-                model.Weight.food_id == food.id,
-                model.Weight.measurement_desc == row_in[2],
-            )).\
-            delete()
-    session.commit()
-
-    weight = session.\
-            query(model.Weight).\
-            filter(model.Weight.food_id == food.id).\
-            filter(model.Weight.measurement_desc == row_in[1]).\
-            one()
-
-    prev_sequence = session.\
-            query(func.max(model.Weight.sequence)).\
-            filter(model.Weight.food_id == food.id).\
-            scalar()
-
-    sequence = 1
-    if prev_sequence:
-        sequence = int(prev_sequence) + 1
+    weights = [weight for weight in cache.get_weights(food_id)
+               if weight['measurement_desc'] == row_in[1]]
+    if not weights:
+        raise sqlalchemy.orm.exc.NoResultFound()
+    if len(weights) > 1:
+        raise sqlalchemy.orm.exc.MultipleResultsFound()
+    weight = weights[0]
 
-    return {
-        'food_id': food.id,
+    result = {
+        'food_id': food_id,
         'sequence': sequence,
-        'amount': weight.amount,
+        'amount': weight['amount'],
         'measurement_desc': row_in[2],
-        'grams': weight.grams,
-        'num_data_points': weight.num_data_points,
-        'std_dev': weight.std_dev
+        'grams': weight['grams'],
+        'num_data_points': weight.get('num_data_points'),
+        'std_dev': weight.get('std_dev')
     }
+    cache.get_weights(food_id).append(result)
+    return result
 
-def db_import_nutrient_category_map_file(engine, session, fname):
+@instrumentation.instrumented
+def db_import_nutrient_category_map_file(engine, session, fname, cache):
     print("Processing file '{}'".format(fname))
+    nutrient_table = model.Nutrient.__table__
+    category_table = model.NutrientCategory.__table__
 
     # Sigh. There are two instances of the nutrient, 'Energy', each
     # with a different unit of measurement: kcal and kJ. Rename
-    # the nutrient before proceeding.
-    energies = session.\
-        query(model.Nutrient).\
-        filter(model.Nutrient.name == 'Energy')
-    for energy in energies:
-        if energy.units == 'kcal':
-            energy.name = 'Energy (kcal)'
-        elif energy.units == 'kJ':
-            energy.name = 'Energy (kJ)'
-        session.add(energy)
-
-    session.commit()
+    # the nutrient, along with the category assignments below.
+    nutrients = {}
+    for row in session.execute(select([nutrient_table.c.id, nutrient_table.c.name,
+                                       nutrient_table.c.units, nutrient_table.c.category_id])):
+        name = row['name']
+        if name == 'Energy':
+            if row['units'] == 'kcal':
+                name = 'Energy (kcal)'
+            elif row['units'] == 'kJ':
+                name = 'Energy (kJ)'
+        nutrients[row['id']] = {'key_id': row['id'], 'name': name, 'category_id': row['category_id'],
+                                'changed': name != row['name']}
+
+    nutrient_ids = LookupCache.load_ids((nutrient['name'], nutrient_id)
+                                        for nutrient_id, nutrient in nutrients.items())
+    category_ids = LookupCache.load_ids(
+        session.execute(select([category_table.c.name, category_table.c.id])))
 
+    # Validate every line before updating anything
+    errors = []
     with open(fname) as f:
         csvreader = csv.reader(f, delimiter='|')
-        rows_out = []
-        for row_in in csvreader:
-            nutrient = session.\
-                query(model.Nutrient).\
-                filter(model.Nutrient.name == row_in[0]).\
-                one()
+        for line_num, row_in in enumerate(csvreader, 1):
+            try:
+                nutrient_id = LookupCache.get_id(nutrient_ids, row_in[0])
+            except sqlalchemy.orm.exc.NoResultFound:
+                errors.append("line {}: unable to find nutrient '{}'".format(line_num, row_in[0]))
+                continue
+            except sqlalchemy.orm.exc.MultipleResultsFound:
+                errors.append("line {}: multiple results of nutrient '{}'".format(line_num, row_in[0]))
+                continue
 
-            category = session.\
-                query(model.NutrientCategory).\
-                filter(model.NutrientCategory.name == row_in[1]).\
-                one()
+            try:
+                category_id = LookupCache.get_id(category_ids, row_in[1])
+            except sqlalchemy.orm.exc.NoResultFound:
+                errors.append("line {}: unable to find nutrient category '{}'".format(line_num, row_in[1]))
+                continue
+            except sqlalchemy.orm.exc.MultipleResultsFound:
+                errors.append("line {}: multiple results of nutrient category '{}'".format(line_num, row_in[1]))
+                continue
 
-            nutrient.category_id = category.id
-            session.add(nutrient)
+            nutrients[nutrient_id]['category_id'] = category_id
+            nutrients[nutrient_id]['changed'] = True
 
-        session.commit()
+    if errors:
+        raise ValueError("Invalid nutrient category map '{}':\n{}".format(fname, '\n'.join(errors)))
+
+    updates = [nutrient for nutrient in nutrients.values() if nutrient.pop('changed')]
+    if updates:
+        session.execute(
+            nutrient_table.update().\
+                where(nutrient_table.c.id == bindparam('key_id')).\
+                values(name=bindparam('name'), category_id=bindparam('category_id')),
+            updates)
+    cache.set_nutrient_ids(nutrient_ids)
 
+@instrumentation.instrumented
 def process_row_local_food_nutrient_data(row_in, args):
-    session = args['session']
+    cache = args['cache']
 
     try:
-        food = session.\
-            query(model.Food).\
-            filter(model.Food.long_desc == row_in[0]).\
-            one()
+        food_id = cache.get_food_id(row_in[0])
     except sqlalchemy.orm.exc.NoResultFound:
         raise ValueError("Unable to find USDA Food '{}'".format(row_in[0]))
     except sqlalchemy.orm.exc.MultipleResultsFound:
         raise ValueError("Multiple results of food '{}'".format(row_in[0]))
 
     try:
-        nutrient = session.\
-            query(model.Nutrient).\
-            filter(model.Nutrient.name == row_in[1]).\
-            one()
+        nutrient_id = cache.get_nutrient_id(row_in[1])
     except sqlalchemy.orm.exc.NoResultFound:
         raise ValueError("Unable to find nutrient '{}'".format(row_in[1]))
     except sqlalchemy.orm.exc.MultipleResultsFound:
         raise ValueError("Multiple results of nutrient '{}'".format(row_in[1]))
 
     return {
-        'food_id': food.id,
-        'nutrient_id': nutrient.id,
+        'food_id': food_id,
+        'nutrient_id': nutrient_id,
         'source_code_id': 9,
         'value': row_in[2],
         'num_data_points': 0
     }
 
+@instrumentation.instrumented
 def process_row_local_food_nutrient_data_alias(row_in, args):
     session = args['session']
+    cache = args['cache']
 
     try:
-        dst_food = session.\
-            query(model.Food).\
-            filter(model.Food.long_desc == row_in[0]).\
-            one()
+        dst_food_id = cache.get_food_id(row_in[0])
     except sqlalchemy.orm.exc.NoResultFound:
         raise ValueError("Unable to find destination food '{}'".format(row_in[0]))
     except sqlalchemy.orm.exc.MultipleResultsFound:
         raise ValueError("Multiple results of destination food '{}'".format(row_in[0]))
 
-    session.\
-        query(model.FoodNutrientData).\
-        filter(model.FoodNutrientData.food_id == dst_food.id).\
-        delete()
-    session.commit()
+    table = model.FoodNutrientData.__table__
+    session.execute(table.delete().where(table.c.food_id == dst_food_id))
 
     try:
-        src_food = session.\
-            query(model.Food).\
-            filter(model.Food.long_desc == row_in[1]).\
-            one()
+        src_food_id = cache.get_food_id(row_in[1])
     except sqlalchemy.orm.exc.NoResultFound:
         raise ValueError("Unable to find source food '{}'".format(row_in[1]))
     except sqlalchemy.orm.exc.MultipleResultsFound:
         raise ValueError("Multiple results of source food '{}'".format(row_in[1]))
 
-    src_nutrient_data = session.\
-        query(model.FoodNutrientData).\
-        filter(model.FoodNutrientData.food_id == src_food.id).\
-        all()
-    for nutrient_datum in src_nutrient_data:
-        session.expunge(nutrient_datum)
-        make_transient(nutrient_datum)
-        nutrient_datum.food_id = dst_food.id
-        session.add(nutrient_datum)
-    session.commit()
+    # Copy the nutrient data of the source food within the database
+    copied_cols = [col for col in table.columns if col.name != 'food_id']
+    session.execute(
+        table.insert().from_select(
+            ['food_id'] + [col.name for col in copied_cols],
+            select([literal(dst_food_id, Integer)] + copied_cols).\
+                where(table.c.food_id == src_food_id)))
 
     return None
 
-def db_import(engine, session, data_dir):
-    # Only drop the USDA tables as the model may be extended by another
-    # module.
-    for name, obj in inspect.getmembers(sys.modules['usdanutrient.model']):
-        if (inspect.isclass(obj)
-                and obj.__module__ == 'usdanutrient.model'):
-            obj.__table__.drop(engine, checkfirst=True)
-            obj.__table__.create(engine)
-
-    fnames = os.listdir(data_dir)
-    for fname in fnames:
-        table_class = None
-        col_order = []
-        full_fname = os.path.join(data_dir, fname)
+def get_release_file_spec(fname):
+    table_class = None
+    col_order = []
+
+    if fname == 'DATA_SRC.txt':
+        table_class = model.DataSource
+        col_order = ['id', 'authors', 'title', 'year', 'journal', 'volume_city',
+                     'issue_state', 'start_page', 'end_page']
+    elif fname == 'DATSRCLN.txt':
+        table_class = model.FoodNutrientDataSourceMap
+        col_order = ['food_id', 'nutrient_id', 'data_source_id']
+    elif fname == 'DERIV_CD.txt':
+        table_class = model.DerivationCode
+        col_order = ['id', 'desc']
+    elif fname == 'FD_GROUP.txt':
+        table_class = model.FoodGroup
+        col_order = ['id', 'name']
+    elif fname == 'FOOD_DES.txt':
+        table_class = model.Food
+        col_order = ['id', 'group_id', 'long_desc', 'short_desc', 'common_name',
+                     'manufacturer', 'has_fndds_profile', 'refuse_desc', 'refuse_pct',
+                     'sci_name', 'nitrogen_protein_factor', 'protein_calories_factor',
+                     'fat_calories_factor', 'carb_calories_factor']
+    elif fname == 'FOOTNOTE.txt':
+        table_class = model.Footnote
+        col_order = ['food_id', 'orig_id', 'type', 'nutrient_id', 'desc']
+    elif fname == 'LANGDESC.txt':
+        table_class = model.Langual
+        col_order = ['id', 'desc']
+    elif fname == 'LANGUAL.txt':
+        table_class = model.FoodLangualMap
+        col_order = ['food_id', 'langual_id']
+    elif fname == 'NUT_DATA.txt':
+        table_class = model.FoodNutrientData
+        col_order = ['food_id', 'nutrient_id', 'value', 'num_data_points', 'std_error',
+                     'source_code_id', 'derivation_code_id', 'missing_food_id',
+                     'is_fortified', 'num_studies', 'min_value', 'max_value',
+                     'degrees_freedom', 'lower_95_error_bound', 'upper_95_error_bound',
+                     'stat_comments', 'last_modified', 'confidence_code']
+    elif fname == 'NUTR_DEF.txt':
+        table_class = model.Nutrient
+        col_order = ['id', 'units', 'infoods_tag', 'name', 'num_decimals', 'sr_order']
+    elif fname == 'SRC_CD.txt':
+        table_class = model.SourceCode
+        col_order = ['id', 'desc']
+    elif fname == 'WEIGHT.txt':
+        table_class = model.Weight
+        col_order = ['food_id', 'sequence', 'amount', 'measurement_desc',
+                     'grams', 'num_data_points', 'std_dev']
+
+    return table_class, col_order
+
+def get_model_classes():
+    # Only the USDA tables, as the model may be extended by another module.
+    # The classes are sorted such that referenced tables come first.
+    table_classes = [obj for name, obj in inspect.getmembers(sys.modules['usdanutrient.model'])
+                     if inspect.isclass(obj) and obj.__module__ == 'usdanutrient.model']
+    order = dict((table, ind) for ind, table in
+                 enumerate(sort_tables([obj.__table__ for obj in table_classes])))
+    return sorted(table_classes, key=lambda obj: order[obj.__table__])
+
+def get_table_dependencies(table_classes):
+    # Map each table name to the names of the tables that it references
+    # through a foreign key, limited to the given tables.
+    names = set(obj.__tablename__ for obj in table_classes)
+    dependencies = {}
+    for table_class in table_classes:
+        table = table_class.__table__
+        dependencies[table.name] = set(
+            fk.column.table.name for fk in table.foreign_keys
+            if fk.column.table is not table and fk.column.table.name in names)
+    return dependencies
+
+def db_import_file_worker(engine_settings, table_class, fname, col_order, batch_size, bulk_load):
+    # Each worker process uses its own engine, and hence connection, with
+    # the pool settings of the engine of the import. The wait stats of its
+    # pool, if monitored, are returned to be added to those of that engine.
+    engine = engineservice.create_configured_engine(engine_settings)
+    try:
+        print("Processing file '{}' with class '{}'".format(fname, table_class.__name__))
+        num_rows = db_import_file(engine, table_class, fname, col_order, batch_size, bulk_load)
+        return table_class.__tablename__, num_rows, get_wait_stats_snapshot(engine), None
+    except Exception:
+        return table_class.__tablename__, None, get_wait_stats_snapshot(engine), traceback.format_exc()
+    finally:
+        engine.dispose()
 
-        if fname == 'DATA_SRC.txt':
-            table_class = model.DataSource
-            col_order = ['id', 'authors', 'title', 'year', 'journal', 'volume_city',
-                         'issue_state', 'start_page', 'end_page']
-        elif fname == 'DATSRCLN.txt':
-            table_class = model.FoodNutrientDataSourceMap
-            col_order = ['food_id', 'nutrient_id', 'data_source_id']
-        elif fname == 'DERIV_CD.txt':
-            table_class = model.DerivationCode
-            col_order = ['id', 'desc']
-        elif fname == 'FD_GROUP.txt':
-            table_class = model.FoodGroup
-            col_order = ['id', 'name']
-        elif fname == 'FOOD_DES.txt':
-            table_class = model.Food
-            col_order = ['id', 'group_id', 'long_desc', 'short_desc', 'common_name',
-                         'manufacturer', 'has_fndds_profile', 'refuse_desc', 'refuse_pct',
-                         'sci_name', 'nitrogen_protein_factor', 'protein_calories_factor',
-                         'fat_calories_factor', 'carb_calories_factor']
-        elif fname == 'FOOTNOTE.txt':
-            table_class = model.Footnote
-            col_order = ['food_id', 'orig_id', 'type', 'nutrient_id', 'desc']
-        elif fname == 'LANGDESC.txt':
-            table_class = model.Langual
-            col_order = ['id', 'desc']
-        elif fname == 'LANGUAL.txt':
-            table_class = model.FoodLangualMap
-            col_order = ['food_id', 'langual_id']
-        elif fname == 'NUT_DATA.txt':
-            table_class = model.FoodNutrientData
-            col_order = ['food_id', 'nutrient_id', 'value', 'num_data_points', 'std_error',
-                         'source_code_id', 'derivation_code_id', 'missing_food_id',
-                         'is_fortified', 'num_studies', 'min_value', 'max_value',
-                         'degrees_freedom', 'lower_95_error_bound', 'upper_95_error_bound',
-                         'stat_comments', 'last_modified', 'confidence_code']
-        elif fname == 'NUTR_DEF.txt':
-            table_class = model.Nutrient
-            col_order = ['id', 'units', 'infoods_tag', 'name', 'num_decimals', 'sr_order']
-        elif fname == 'SRC_CD.txt':
-            table_class = model.SourceCode
-            col_order = ['id', 'desc']
-        elif fname == 'WEIGHT.txt':
-            table_class = model.Weight
-            col_order = ['food_id', 'sequence', 'amount', 'measurement_desc',
-                         'grams', 'num_data_points', 'std_dev']
+def get_wait_stats_snapshot(engine):
+    wait_stats = engineservice.get_wait_stats(engine)
+    return wait_stats.snapshot() if wait_stats is not None else None
+
+def run_import_file_worker(conn, *args):
+    # Sends the result of db_import_file_worker to the parent process
+    conn.send(db_import_file_worker(*args))
+    conn.close()
+
+def db_import_files_parallel(engine, tasks, dependencies, jobs, batch_size=DEFAULT_BATCH_SIZE,
+                             bulk_load=True):
+    # tasks maps table names to (table_class, fname, col_order). A table is
+    # loaded as soon as all the tables that it depends on are loaded, by
+    # its own worker process, up to jobs at a time. Each worker sends its
+    # result through its own pipe, which is polled, so that a worker that
+    # dies, e.g. when killed, fails the import instead of leaving it waiting
+    # forever; a multiprocessing.Pool can neither notice the death of its
+    # workers nor always be terminated after one.
+
+    # Pooled connections must not be shared with the forked workers
+    engine.dispose()
+
+    engine_settings = engineservice.get_engine_settings(engine)
+    wait_stats = engineservice.get_wait_stats(engine)
+    running = {}
+    try:
+        pending = set(tasks)
+        loaded = set()
+        while pending or running:
+            for name in sorted(pending):
+                if len(running) < jobs and dependencies[name] <= loaded:
+                    pending.remove(name)
+                    table_class, fname, col_order = tasks[name]
+                    recv_conn, send_conn = multiprocessing.Pipe(duplex=False)
+                    process = multiprocessing.Process(
+                        target=run_import_file_worker,
+                        args=(send_conn, engine_settings, table_class, fname, col_order, batch_size, bulk_load))
+                    process.start()
+                    send_conn.close()
+                    running[name] = (process, recv_conn)
+
+            if not running:
+                raise ValueError("Circular foreign key dependencies between tables: {}".format(
+                    ', '.join(sorted(pending))))
+
+            num_finished = 0
+            for name, (process, conn) in sorted(running.items()):
+                # A worker that exited has sent its result, if any, before;
+                # the pipe of a worker that died reads as closed
+                exited = process.exitcode is not None
+                if not conn.poll() and not exited:
+                    continue
+                try:
+                    result = conn.recv()
+                except EOFError:
+                    process.join()
+                    raise RuntimeError("Import worker {} exited with code {} while loading table '{}'".format(
+                        process.pid, process.exitcode, name))
+
+                del running[name]
+                conn.close()
+                process.join()
+                num_finished += 1
+                name, num_rows, worker_wait_stats, error = result
+                if wait_stats is not None and worker_wait_stats is not None:
+                    wait_stats.merge(worker_wait_stats)
+                if error:
+                    raise ValueError("Unable to import table '{}':\n{}".format(name, error))
+                loaded.add(name)
+
+            if not num_finished:
+                time.sleep(WORKER_POLL_INTERVAL)
+    finally:
+        for process, conn in running.values():
+            process.terminate()
+            process.join()
+            conn.close()
+
+def has_autoincrement_key(table):
+    key_cols = list(table.primary_key.columns)
+    return (len(key_cols) == 1
+            and isinstance(key_cols[0].type, Integer)
+            and key_cols[0].autoincrement is not False)
+
+def create_tables_deferred(engine, table_classes):
+    # Create the tables without foreign keys, indexes and, unless it is
+    # autoincremented, the primary key. Returns the stages of statements
+    # that add them once the tables are loaded; each stage is a list of
+    # jobs, one per table.
+    #
+    # The statements are built from a copy of the tables, since
+    # AddConstraint disables the inline creation of its constraint.
+    metadata = MetaData()
+    tables = [table_class.__table__.tometadata(metadata) for table_class in table_classes]
+    primary_key_jobs = []
+    constraint_jobs = []
+    for table in tables:
+        if has_autoincrement_key(table):
+            engine.execute(CreateTable(table, include_foreign_key_constraints=[]))
+        else:
+            bare_cols = [Column(col.name, col.type.copy(), nullable=col.nullable) for col in table.columns]
+            Table(table.name, MetaData(), *bare_cols).create(engine)
+            primary_key_jobs.append([AddConstraint(table.primary_key)])
+
+        statements = [AddConstraint(fk) for fk in table.foreign_key_constraints]
+        statements.extend(CreateIndex(index) for index in table.indexes)
+        if statements:
+            constraint_jobs.append(statements)
+
+    return [primary_key_jobs, constraint_jobs]
+
+def create_deferred_constraints(engine, stages, jobs=1):
+    # Primary keys are added before the foreign keys that reference them.
+    # The jobs of a stage are independent and may run in parallel, each
+    # on its own pooled connection.
+    start = time.time()
+
+    def run_job(statements):
+        for statement in statements:
+            engine.execute(statement)
+
+    for stage in stages:
+        if jobs > 1:
+            pool = ThreadPool(jobs)
+            try:
+                pool.map(run_job, stage)
+            finally:
+                pool.close()
+                pool.join()
         else:
+            for statements in stage:
+                run_job(statements)
+
+    print("Created primary keys, foreign keys and indexes in {:.2f}s".format(time.time() - start))
+
+def get_release_file_tasks(data_dir):
+    # Map table names to (table_class, fname, col_order) for the release
+    # files of data_dir.
+    tasks = {}
+    for fname in sorted(os.listdir(data_dir)):
+        full_fname = os.path.join(data_dir, fname)
+        table_class, col_order = get_release_file_spec(fname)
+        if not col_order:
             print("No handler for file {}".format(full_fname))
+        else:
+            tasks[table_class.__tablename__] = (table_class, full_fname, col_order)
+    return tasks
+
+def hash_file(fname):
+    content_hash = hashlib.sha1()
+    with open(fname, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            content_hash.update(chunk)
+    return content_hash.hexdigest()
+
+def record_file_hashes(conn, file_hashes):
+    # file_hashes maps file names to content hashes; only the base name of
+    # each file is recorded, so that it matches across release directories.
+    if not file_hashes:
+        return
+
+    table = model.ImportFile.__table__
+    names = [os.path.basename(fname) for fname in file_hashes]
+    conn.execute(table.delete().where(table.c.name.in_(names)))
+    imported_at = datetime.now()
+    conn.execute(table.insert(), [
+        {'name': os.path.basename(fname), 'content_hash': content_hash, 'imported_at': imported_at}
+        for fname, content_hash in file_hashes.items()])
+
+def bump_dataset_version(conn):
+    # Replace the stamp of the loaded data, so that caches of earlier
+    # imports are invalidated.
+    table = model.DatasetVersion.__table__
+    conn.execute(table.delete())
+    conn.execute(table.insert(), {'id': 1, 'stamp': uuid.uuid4().hex, 'updated_at': datetime.now()})
+
+def get_diff_columns(table, col_names):
+    # Numeric values are compared as floats, as hashing Decimals is slow
+    return [type_coerce(table.c[col_name], Float) if type(table.c[col_name].type) is Numeric
+            else table.c[col_name]
+            for col_name in col_names]
+
+def get_diff_value(value):
+    if isinstance(value, Decimal):
+        return float(value)
+    return value
+
+def is_keyed_by_row(table, col_order):
+    # Tables whose primary key is not in the release file, i.e. Footnote,
+    # are compared on the whole row and have no updates
+    return not set(col.name for col in table.primary_key.columns) <= set(col_order)
+
+def get_existing_rows(conn, table_class, col_order):
+    # Maps the primary key of each row of the table to the hash of its
+    # other values, which is all that is kept, to bound memory. Tables keyed
+    # by row map each row to the list of the primary keys of its copies.
+    table = table_class.__table__
+    key_cols = [col.name for col in table.primary_key.columns]
+    existing = {}
+    if is_keyed_by_row(table, col_order):
+        query = select([table.c[col_name] for col_name in key_cols] + get_diff_columns(table, col_order))
+        for row in conn.execute(query):
+            existing.setdefault(tuple(row[len(key_cols):]), []).append(tuple(row[:len(key_cols)]))
+    else:
+        value_cols = [col_name for col_name in col_order if col_name not in key_cols]
+        query = select(get_diff_columns(table, key_cols + value_cols))
+        for row in conn.execute(query):
+            existing[tuple(row[:len(key_cols)])] = hash(tuple(row[len(key_cols):]))
+    return existing
+
+def iter_table_changes(table_class, fname, col_order, existing):
+    # Compares a release file with the existing rows of its table, and
+    # yields ('insert', row) and ('update', row) for the lines that differ.
+    # The existing rows that match a line are removed from existing, so
+    # that the rows left once the file is read are those to delete.
+    table = table_class.__table__
+    if is_keyed_by_row(table, col_order):
+        for row in iter_file_rows(table_class, fname, col_order):
+            keys = existing.get(tuple([get_diff_value(value) for value in row]))
+            if keys:
+                keys.pop()
+            else:
+                yield 'insert', row
+        return
+
+    key_cols = [col.name for col in table.primary_key.columns]
+    key_inds = [col_order.index(col_name) for col_name in key_cols]
+    value_inds = [ind for ind, col_name in enumerate(col_order) if col_name not in key_cols]
+    for row in iter_file_rows(table_class, fname, col_order):
+        key = tuple([row[ind] for ind in key_inds])
+        values = tuple([get_diff_value(row[ind]) for ind in value_inds])
+        value_hash = existing.pop(key, None)
+        if value_hash is None:
+            yield 'insert', row
+        elif value_hash != hash(values):
+            yield 'update', row
 
-        if col_order:
-            print("Processing file '{}' with class '{}'".format(full_fname, table_class.__name__))
-            db_import_file(engine, table_class, full_fname, col_order)
+def get_table_deletes(table_class, col_order, existing):
+    # The primary keys of the existing rows that no line of the file matched
+    table = table_class.__table__
+    key_cols = [col.name for col in table.primary_key.columns]
+    if is_keyed_by_row(table, col_order):
+        return [dict(zip(key_cols, key)) for keys in existing.values() for key in keys]
+    return [dict(zip(key_cols, key)) for key in existing]
 
-def db_import_custom(engine, session, data_dir):
-    model.NutrientCategory.__table__.drop(engine, checkfirst=True)
-    model.NutrientCategory.__table__.create(engine)
+def apply_table_upserts(conn, table_class, col_order, changes, batch_size=DEFAULT_BATCH_SIZE):
+    # Applies the changes of iter_table_changes as they are read, batch_size
+    # rows per statement. Returns the numbers of inserts and updates.
+    table = table_class.__table__
+    key_cols = [col.name for col in table.primary_key.columns]
+    value_cols = [col_name for col_name in col_order if col_name not in key_cols]
+    update = table.update().\
+        where(and_(*[table.c[col_name] == bindparam('key_' + col_name) for col_name in key_cols])).\
+        values(dict((col_name, bindparam(col_name)) for col_name in value_cols))
 
-    import_order = ['local_food.csv', 'local_food_weight.csv', 'local_food_weight_alias.csv',
-                    'nutrient_category.csv', 'nutrient_category_map.csv',
-                    'local_food_nutrient_data.csv', 'local_food_nutrient_data_alias.csv']
-    for fname in import_order:
+    def flush_inserts(rows):
+        conn.execute(table.insert(), [dict(zip(col_order, row)) for row in rows])
+
+    def flush_updates(rows):
+        params = []
+        for row in rows:
+            param = dict(zip(col_order, row))
+            for col_name in key_cols:
+                param['key_' + col_name] = param.pop(col_name)
+            params.append(param)
+        conn.execute(update, params)
+
+    batches = {'insert': [], 'update': []}
+    flush = {'insert': flush_inserts, 'update': flush_updates}
+    counts = {'insert': 0, 'update': 0}
+    for kind, row in changes:
+        batch = batches[kind]
+        batch.append(row)
+        counts[kind] += 1
+        if len(batch) >= batch_size:
+            flush[kind](batch)
+            del batch[:]
+    for kind, batch in batches.items():
+        if batch:
+            flush[kind](batch)
+    return counts['insert'], counts['update']
+
+def get_referencing_foreign_keys(table):
+    # The foreign keys of the other tables that refer to the table
+    return [fk for other_table in model.Base.metadata.sorted_tables if other_table is not table
+            for fk in other_table.foreign_keys if fk.column.table is table]
+
+def apply_table_deletes(conn, table_class, deletes, batch_size=DEFAULT_BATCH_SIZE):
+    # The rows of other tables that refer to the deleted rows, e.g. the
+    # weights and nutrient data of a deleted food, are deleted first, even
+    # if their own file did not change, so that no foreign key is left
+    # dangling.
+    table = table_class.__table__
+    key_cols = [col.name for col in table.primary_key.columns]
+    for fk in get_referencing_foreign_keys(table):
+        if fk.column.name not in key_cols:
+            continue
+        statement = fk.parent.table.delete().where(fk.parent == bindparam('key_' + fk.column.name))
+        for batch in bulkloader.iter_batches(deletes, batch_size):
+            conn.execute(statement, [{'key_' + fk.column.name: key[fk.column.name]} for key in batch])
+
+    statement = table.delete().\
+        where(and_(*[table.c[col_name] == bindparam('key_' + col_name) for col_name in key_cols]))
+    for batch in bulkloader.iter_batches(deletes, batch_size):
+        conn.execute(statement, [dict(('key_' + col_name, value) for col_name, value in key.items())
+                                 for key in batch])
+
+def has_custom_import(connectable):
+    # Whether the custom files were imported since the release was loaded
+    table = model.ImportFile.__table__
+    if not table.exists(connectable):
+        return False
+    return connectable.execute(
+        select([table.c.name]).where(table.c.name.in_(CUSTOM_IMPORT_ORDER)).limit(1)).first() is not None
+
+def db_import_incremental(engine, session, data_dir, batch_size=DEFAULT_BATCH_SIZE, custom_data_dir=None):
+    # Apply the differences between the release files and the loaded tables
+    # in the transaction of the session, rather than dropping and reloading
+    # them. Files whose content hash matches the last import are skipped.
+    #
+    # Rows added or changed by the custom import are not in the release
+    # files, so the diffs delete the local foods, along with their weights
+    # and nutrient data, and revert the renamed nutrients. The custom files
+    # of custom_data_dir, if given, are then applied again within the same
+    # transaction.
+    table_classes = get_model_classes()
+    for table_class in table_classes:
+        table_class.__table__.create(engine, checkfirst=True)
+
+    tasks = get_release_file_tasks(data_dir)
+    import_files = model.ImportFile.__table__
+    try:
+        prev_hashes = dict(session.execute(select([import_files.c.name, import_files.c.content_hash])).fetchall())
+
+        file_hashes = {}
+        for name, (table_class, fname, col_order) in tasks.items():
+            content_hash = hash_file(fname)
+            if prev_hashes.get(os.path.basename(fname)) == content_hash:
+                print("Skipping unchanged file '{}'".format(fname))
+            else:
+                file_hashes[fname] = content_hash
+
+        # Inserts and updates are applied to referenced tables first, and
+        # deletes to referencing tables first.
+        diffs = []
+        for table_class in table_classes:
+            if table_class.__tablename__ not in tasks:
+                continue
+            table_class, fname, col_order = tasks[table_class.__tablename__]
+            if fname not in file_hashes:
+                continue
+
+            print("Processing file '{}' with class '{}'".format(fname, table_class.__name__))
+            existing = get_existing_rows(session, table_class, col_order)
+            changes = iter_table_changes(table_class, fname, col_order, existing)
+            num_inserts, num_updates = apply_table_upserts(session, table_class, col_order, changes, batch_size)
+            deletes = get_table_deletes(table_class, col_order, existing)
+            print("Applied {} inserts and {} updates to '{}', and {} deletes pending".format(
+                num_inserts, num_updates, table_class.__tablename__, len(deletes)))
+            diffs.append((table_class, deletes))
+
+        for table_class, deletes in reversed(diffs):
+            apply_table_deletes(session, table_class, deletes, batch_size)
+
+        if custom_data_dir is not None:
+            apply_custom_files(engine, session, custom_data_dir, batch_size)
+
+        record_file_hashes(session, file_hashes)
+        if diffs or custom_data_dir is not None:
+            statsservice.refresh_nutrient_stats(session)
+            bump_dataset_version(session)
+        session.commit()
+    except:
+        session.rollback()
+        raise
+
+def db_import(engine, session, data_dir, batch_size=DEFAULT_BATCH_SIZE, bulk_load=True, jobs=1,
+              defer_indexes=False):
+    if defer_indexes and engine.dialect.name not in DEFERRED_INDEX_DIALECTS:
+        print("Deferred index creation is not supported by {}; creating the tables with their indexes".format(
+            engine.dialect.name))
+        defer_indexes = False
+
+    table_classes = get_model_classes()
+    for table_class in reversed(table_classes):
+        table_class.__table__.drop(engine, checkfirst=True)
+    if defer_indexes:
+        deferred_stages = create_tables_deferred(engine, table_classes)
+    else:
+        for table_class in table_classes:
+            table_class.__table__.create(engine)
+
+    tasks = get_release_file_tasks(data_dir)
+    if jobs > 1 and engine.dialect.name == 'sqlite':
+        print("SQLite does not support concurrent writers; loading the tables serially")
+        jobs = 1
+
+    if jobs > 1:
+        # Without foreign keys, the tables may be loaded in any order
+        if defer_indexes:
+            dependencies = dict((name, set()) for name in tasks)
+        else:
+            dependencies = get_table_dependencies([task[0] for task in tasks.values()])
+        db_import_files_parallel(engine, tasks, dependencies, jobs, batch_size, bulk_load)
+    else:
+        for table_class in table_classes:
+            if table_class.__tablename__ in tasks:
+                table_class, full_fname, col_order = tasks[table_class.__tablename__]
+                print("Processing file '{}' with class '{}'".format(full_fname, table_class.__name__))
+                db_import_file(engine, table_class, full_fname, col_order, batch_size, bulk_load)
+
+    if defer_indexes:
+        create_deferred_constraints(engine, deferred_stages, jobs)
+
+    with engine.begin() as conn:
+        record_file_hashes(conn, dict((task[1], hash_file(task[1])) for task in tasks.values()))
+        statsservice.refresh_nutrient_stats(conn)
+        bump_dataset_version(conn)
+
+def clear_nutrient_categories(session):
+    # The categories are replaced by every custom import; the nutrients are
+    # unassigned first, so that no foreign key refers to a deleted category
+    session.execute(model.Nutrient.__table__.update().values(category_id=None))
+    session.execute(model.NutrientCategory.__table__.delete())
+
+def apply_custom_files(engine, session, data_dir, batch_size=DEFAULT_BATCH_SIZE):
+    # Applies the custom files within the transaction of the session, and
+    # records their content hashes, which has_custom_import checks
+    cache = LookupCache(session)
+    clear_nutrient_categories(session)
+    file_hashes = {}
+    for fname in CUSTOM_IMPORT_ORDER:
         full_fname = os.path.join(data_dir, fname)
         if os.access(full_fname, os.R_OK):
+            file_hashes[full_fname] = hash_file(full_fname)
             processing_callback = process_row_generic
             callback_args = {'engine': engine,
                              'session': session,
+                             'cache': cache,
                              'fname': full_fname,
-                             'bulk': True}
+                             'batch_size': batch_size}
 
             if fname == 'local_food.csv':
                 callback_args['table_class'] = model.Food
+                callback_args['delete_callback'] = delete_foods
                 processing_callback = process_row_local_food
             elif fname == 'local_food_weight.csv':
                 callback_args['table_class'] = model.Weight
-                callback_args['bulk'] = False
+                callback_args['delete_callback'] = delete_weights
+                callback_args['row_key'] = get_weight_key
                 processing_callback = process_row_local_food_weight
             elif fname == 'local_food_weight_alias.csv':
                 callback_args['table_class'] = model.Weight
-                callback_args['bulk'] = False
+                callback_args['delete_callback'] = delete_weights
+                callback_args['row_key'] = get_weight_key
                 processing_callback = process_row_local_food_weight_alias
             elif fname == 'nutrient_category.csv':
                 callback_args['table_class'] = model.NutrientCategory
                 callback_args['col_order'] = ['name']
             elif fname == 'nutrient_category_map.csv':
                 processing_callback = None
-                db_import_nutrient_category_map_file(engine, session, full_fname)
+                db_import_nutrient_category_map_file(engine, session, full_fname, cache)
             elif fname == 'local_food_nutrient_data.csv':
                 callback_args['table_class'] = model.FoodNutrientData
                 processing_callback = process_row_local_food_nutrient_data
@@ -429,3 +1075,24 @@ def db_import_custom(engine, session, data_dir):
 
             if processing_callback:
                 db_import_custom_file(processing_callback, callback_args)
+
+    record_file_hashes(session, file_hashes)
+
+def db_import_custom(engine, session, data_dir, batch_size=DEFAULT_BATCH_SIZE):
+    model.NutrientCategory.__table__.create(engine, checkfirst=True)
+    model.ImportFile.__table__.create(engine, checkfirst=True)
+    model.DatasetVersion.__table__.create(engine, checkfirst=True)
+    model.GroupNutrientStats.__table__.create(engine, checkfirst=True)
+    model.NutrientRanking.__table__.create(engine, checkfirst=True)
+
+    # All files are applied within the transaction of the session, which is
+    # committed once at the end, so that a failed run leaves no partially
+    # applied overlay behind.
+    try:
+        apply_custom_files(engine, session, data_dir, batch_size)
+        statsservice.refresh_nutrient_stats(session)
+        bump_dataset_version(session)
+        session.commit()
+    except:
+        session.rollback()
+        raise
@@ -0,0 +1,248 @@
+import contextlib
+import functools
+import json
+import threading
+import time
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+# Scope of the statements executed outside of any instrumented function
+ROOT_SCOPE = '<root>'
+
+_recorder = None
+
+class Recorder(object):
+    # Collects the statements executed by an engine, the calls of the
+    # instrumented functions and the stages of the release file loads. Each
+    # statement is attributed to the innermost instrumented function, or
+    # scope, of the thread that executes it. Only the current process is
+    # recorded, i.e. not the worker processes of parallel imports, and the
+    # statements of the native bulk loaders are recorded as stages.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.statements = {}
+        self.functions = {}
+        self.stages = {}
+        self.sessions = {'flushes': 0, 'commits': 0, 'rollbacks': 0}
+        self.engines = []
+        self.pools = {}
+
+    def __repr__(self):
+        return "<Recorder(statements='{}', functions='{}', stages='{}')>".format(
+            len(self.statements), len(self.functions), len(self.stages))
+
+    def get_scope(self):
+        stack = getattr(self.local, 'stack', None)
+        return stack[-1] if stack else ROOT_SCOPE
+
+    @contextlib.contextmanager
+    def scope(self, name):
+        stack = getattr(self.local, 'stack', None)
+        if stack is None:
+            stack = self.local.stack = []
+        stack.append(name)
+        start = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - start
+            stack.pop()
+            with self.lock:
+                stats = self.functions.setdefault(name, {'calls': 0, 'total_s': 0.0, 'max_s': 0.0})
+                stats['calls'] += 1
+                stats['total_s'] += elapsed
+                stats['max_s'] = max(stats['max_s'], elapsed)
+
+    def record_statement(self, statement, elapsed, rowcount, executemany, num_params):
+        # Statements are grouped by scope and text; rowcount is the number
+        # of rows that the statement affected, if the driver reports it.
+        key = (self.get_scope(), statement)
+        with self.lock:
+            stats = self.statements.get(key)
+            if stats is None:
+                stats = self.statements[key] = {'round_trips': 0, 'params': 0, 'rows': 0,
+                                                'total_s': 0.0, 'max_s': 0.0}
+            stats['round_trips'] += 1
+            stats['params'] += num_params if executemany else 1
+            if rowcount is not None and rowcount >= 0:
+                stats['rows'] += rowcount
+            stats['total_s'] += elapsed
+            stats['max_s'] = max(stats['max_s'], elapsed)
+
+    def record_stages(self, table_name, num_rows, times):
+        with self.lock:
+            stats = self.stages.setdefault(table_name, {'rows': 0, 'parse_s': 0.0, 'convert_s': 0.0, 'write_s': 0.0})
+            stats['rows'] += num_rows
+            for stage in ('parse', 'convert', 'write'):
+                stats[stage + '_s'] += times.get(stage, 0)
+
+    def before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('instrumentation_start', []).append(time.time())
+
+    def after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.time() - conn.info['instrumentation_start'].pop()
+        num_params = len(parameters) if executemany else 1
+        self.record_statement(' '.join(statement.split()), elapsed, cursor.rowcount, executemany, num_params)
+
+    def after_flush(self, session, flush_context):
+        with self.lock:
+            self.sessions['flushes'] += 1
+
+    def after_commit(self, session):
+        with self.lock:
+            self.sessions['commits'] += 1
+
+    def after_rollback(self, session):
+        with self.lock:
+            self.sessions['rollbacks'] += 1
+
+    def watch_pool(self, name, wait_stats):
+        # Includes the checkout waits of a pool, e.g. the PoolWaitStats of
+        # engineservice, in the summary
+        with self.lock:
+            self.pools[name] = wait_stats
+
+    def attach(self, engine):
+        event.listen(engine, 'before_cursor_execute', self.before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute', self.after_cursor_execute)
+        self.engines.append(engine)
+
+    def listen_sessions(self):
+        event.listen(Session, 'after_flush', self.after_flush)
+        event.listen(Session, 'after_commit', self.after_commit)
+        event.listen(Session, 'after_rollback', self.after_rollback)
+
+    def detach(self):
+        for engine in self.engines:
+            event.remove(engine, 'before_cursor_execute', self.before_cursor_execute)
+            event.remove(engine, 'after_cursor_execute', self.after_cursor_execute)
+        self.engines = []
+        event.remove(Session, 'after_flush', self.after_flush)
+        event.remove(Session, 'after_commit', self.after_commit)
+        event.remove(Session, 'after_rollback', self.after_rollback)
+
+    def summary(self):
+        with self.lock:
+            statements = [dict(stats, scope=scope, statement=statement)
+                          for (scope, statement), stats in self.statements.items()]
+            statements.sort(key=lambda stats: -stats['total_s'])
+            scopes = {}
+            for stats in statements:
+                totals = scopes.setdefault(stats['scope'], {'statements': 0, 'round_trips': 0, 'rows': 0,
+                                                            'total_s': 0.0})
+                totals['statements'] += 1
+                totals['round_trips'] += stats['round_trips']
+                totals['rows'] += stats['rows']
+                totals['total_s'] += stats['total_s']
+            return {
+                'scopes': scopes,
+                'statements': statements,
+                'functions': dict((name, dict(stats)) for name, stats in self.functions.items()),
+                'stages': dict((name, dict(stats)) for name, stats in self.stages.items()),
+                'sessions': dict(self.sessions),
+                'pools': dict((name, wait_stats.snapshot()) for name, wait_stats in self.pools.items()),
+            }
+
+    def to_prometheus(self):
+        # Prometheus text exposition format of the totals of each scope,
+        # function and stage
+        summary = self.summary()
+        lines = []
+
+        def add_metric(name, metric_type, help_text, samples):
+            lines.append('# HELP {} {}'.format(name, help_text))
+            lines.append('# TYPE {} {}'.format(name, metric_type))
+            for labels, value in samples:
+                label_text = ','.join('{}="{}"'.format(key, str(label).replace('\\', '\\\\').replace('"', '\\"'))
+                                      for key, label in labels)
+                lines.append('{}{{{}}} {}'.format(name, label_text, repr(float(value))))
+
+        scopes = sorted(summary['scopes'].items())
+        add_metric('usdanutrient_sql_round_trips_total', 'counter', 'Statements sent to the database',
+                   [((('scope', scope),), stats['round_trips']) for scope, stats in scopes])
+        add_metric('usdanutrient_sql_rows_total', 'counter', 'Rows affected by the statements',
+                   [((('scope', scope),), stats['rows']) for scope, stats in scopes])
+        add_metric('usdanutrient_sql_seconds_total', 'counter', 'Time spent executing the statements',
+                   [((('scope', scope),), stats['total_s']) for scope, stats in scopes])
+
+        functions = sorted(summary['functions'].items())
+        add_metric('usdanutrient_function_calls_total', 'counter', 'Calls of the instrumented functions',
+                   [((('function', name),), stats['calls']) for name, stats in functions])
+        add_metric('usdanutrient_function_seconds_total', 'counter', 'Time spent in the instrumented functions',
+                   [((('function', name),), stats['total_s']) for name, stats in functions])
+
+        stages = sorted(summary['stages'].items())
+        add_metric('usdanutrient_stage_rows_total', 'counter', 'Rows loaded from the release files',
+                   [((('table', name),), stats['rows']) for name, stats in stages])
+        add_metric('usdanutrient_stage_seconds_total', 'counter', 'Time spent in each stage of the release file loads',
+                   [((('table', name), ('stage', stage)), stats[stage + '_s'])
+                    for name, stats in stages for stage in ('parse', 'convert', 'write')])
+
+        add_metric('usdanutrient_session_events_total', 'counter', 'Flushes, commits and rollbacks of sessions',
+                   [((('event', name),), value) for name, value in sorted(summary['sessions'].items())])
+
+        pools = sorted(summary['pools'].items())
+        add_metric('usdanutrient_pool_checkouts_total', 'counter', 'Connections checked out of the pools',
+                   [((('pool', name),), stats['checkouts']) for name, stats in pools])
+        add_metric('usdanutrient_pool_timeouts_total', 'counter', 'Checkouts that reached the pool timeout',
+                   [((('pool', name),), stats['timeouts']) for name, stats in pools])
+        add_metric('usdanutrient_pool_wait_seconds_total', 'counter', 'Time spent waiting for pooled connections',
+                   [((('pool', name),), stats['total_wait_s']) for name, stats in pools])
+        return '\n'.join(lines) + '\n'
+
+    def save(self, fname):
+        # Writes the summary as Prometheus text if fname ends with .prom, or
+        # as JSON otherwise
+        with open(fname, 'w') as f:
+            if fname.endswith('.prom'):
+                f.write(self.to_prometheus())
+            else:
+                json.dump(self.summary(), f, indent=2, sort_keys=True)
+
+def enable(*engines):
+    # Starts recording the statements of the engines and the instrumented
+    # functions. Returns the active Recorder.
+    global _recorder
+    if _recorder is not None:
+        raise ValueError("Instrumentation is already enabled")
+    recorder = Recorder()
+    for engine in engines:
+        recorder.attach(engine)
+    recorder.listen_sessions()
+    _recorder = recorder
+    return recorder
+
+def disable():
+    global _recorder
+    recorder = _recorder
+    if recorder is not None:
+        recorder.detach()
+        _recorder = None
+    return recorder
+
+def get_recorder():
+    # The active Recorder, or None if instrumentation is disabled
+    return _recorder
+
+@contextlib.contextmanager
+def scope(name):
+    # Attributes the statements executed within the block to name
+    recorder = _recorder
+    if recorder is None:
+        yield
+    else:
+        with recorder.scope(name):
+            yield
+
+def instrumented(func):
+    # Records the calls of the function, and attributes the statements that
+    # it executes to it, while instrumentation is enabled.
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        recorder = _recorder
+        if recorder is None:
+            return func(*args, **kwargs)
+        with recorder.scope(func.__name__):
+            return func(*args, **kwargs)
+    return wrapper
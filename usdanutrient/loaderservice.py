@@ -0,0 +1,222 @@
+import Queue
+import threading
+from collections import OrderedDict
+from sqlalchemy import select
+import model
+import queryservice
+
+# Number of keys loaded per query at most
+DEFAULT_MAX_BATCH_SIZE = queryservice.PROFILE_CHUNK_SIZE
+
+# Seconds that the first load of a batch waits for other loads to join it
+DEFAULT_BATCH_DELAY = 0.002
+
+# Number of batches executed at the same time, i.e. connections in use
+DEFAULT_MAX_CONCURRENCY = 4
+
+class LoadTimeoutError(Exception):
+    pass
+
+class LoaderClosedError(Exception):
+    pass
+
+class PendingLoad(object):
+    # Result of a BatchLoader.load, which is set once the batch of its key
+    # has been queried
+    def __init__(self, key):
+        self.key = key
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+
+    def __repr__(self):
+        return "<PendingLoad(key='{}', done='{}')>".format(self.key, self.done())
+
+    def done(self):
+        return self.event.is_set()
+
+    def set_result(self, value, error=None):
+        self.value = value
+        self.error = error
+        self.event.set()
+
+    def result(self, timeout=None):
+        # Waits up to timeout seconds for the value, or raises
+        # LoadTimeoutError. Errors of the batch query are raised again.
+        if not self.event.wait(timeout):
+            raise LoadTimeoutError("Timed out after {}s loading '{}'".format(timeout, self.key))
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+class BatchLoader(object):
+    # Coalesces the loads of single keys, made by concurrent threads, into
+    # batches that are queried with one call of batch_func, which maps a
+    # list of keys to a dict of their values; keys without a value load as
+    # None. A batch is queried once max_batch_size distinct keys are
+    # pending, or batch_delay seconds after its first load, by one of
+    # max_concurrency worker threads. Loads wait for timeout seconds at
+    # most, unless their own timeout is given.
+    def __init__(self, batch_func, max_batch_size=DEFAULT_MAX_BATCH_SIZE, batch_delay=DEFAULT_BATCH_DELAY,
+                 max_concurrency=DEFAULT_MAX_CONCURRENCY, timeout=None):
+        self.batch_func = batch_func
+        self.max_batch_size = max_batch_size
+        self.batch_delay = batch_delay
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.batch = OrderedDict()
+        self.timer = None
+        self.closed = False
+        self.batches = Queue.Queue()
+        self.num_loads = 0
+        self.num_batches = 0
+        self.num_keys = 0
+        self.workers = []
+        for ind in range(max_concurrency):
+            worker = threading.Thread(target=self.run_worker, name='BatchLoader-{}'.format(ind))
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def __repr__(self):
+        return "<BatchLoader(batch_func='{}', max_batch_size='{}', max_concurrency='{}')>".format(
+            getattr(self.batch_func, '__name__', self.batch_func), self.max_batch_size, len(self.workers))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def load_async(self, key):
+        # Returns the PendingLoad of the key, which is shared by the loads of
+        # the same key within a batch
+        with self.lock:
+            if self.closed:
+                raise LoaderClosedError("The loader is closed")
+            self.num_loads += 1
+            pending = self.batch.get(key)
+            if pending is None:
+                pending = self.batch[key] = PendingLoad(key)
+            if len(self.batch) >= self.max_batch_size:
+                self.dispatch_locked()
+            elif self.timer is None:
+                self.timer = threading.Timer(self.batch_delay, self.dispatch)
+                self.timer.daemon = True
+                self.timer.start()
+        return pending
+
+    def load(self, key, timeout=None):
+        return self.load_async(key).result(timeout if timeout is not None else self.timeout)
+
+    def load_many(self, keys, timeout=None):
+        # The values of the keys, in order, loaded in as few batches as
+        # max_batch_size allows
+        pending = [self.load_async(key) for key in keys]
+        return [load.result(timeout if timeout is not None else self.timeout) for load in pending]
+
+    def dispatch(self):
+        with self.lock:
+            self.dispatch_locked()
+
+    def dispatch_locked(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if self.batch:
+            self.batches.put(self.batch)
+            self.batch = OrderedDict()
+
+    def run_worker(self):
+        while True:
+            batch = self.batches.get()
+            if batch is None:
+                return
+            self.run_batch(batch)
+
+    def run_batch(self, batch):
+        with self.lock:
+            self.num_batches += 1
+            self.num_keys += len(batch)
+        try:
+            values = self.batch_func(list(batch))
+        except Exception as e:
+            for pending in batch.values():
+                pending.set_result(None, e)
+            return
+        for key, pending in batch.items():
+            pending.set_result(values.get(key))
+
+    def close(self):
+        # Queries the pending loads, and stops the workers once they have
+        # executed every batch
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            self.dispatch_locked()
+        for worker in self.workers:
+            self.batches.put(None)
+        for worker in self.workers:
+            worker.join()
+
+    def stats(self):
+        with self.lock:
+            return {'loads': self.num_loads,
+                    'batches': self.num_batches,
+                    'keys': self.num_keys}
+
+def query_food_profiles(connectable, food_ids):
+    return dict((profile.id, profile) for profile in queryservice.get_food_profiles(connectable, food_ids))
+
+def query_foods(connectable, food_ids):
+    table = model.Food.__table__
+    return dict((row.id, row) for row in queryservice.get_rows(connectable, model.Food, table.c.id.in_(food_ids)))
+
+def query_nutrient_values(connectable, food_ids):
+    # Maps each food id to a dict of its nutrient ids and values; foods
+    # without nutrient data map to an empty dict.
+    table = model.FoodNutrientData.__table__
+    values = dict((food_id, {}) for food_id in food_ids)
+    query = select([table.c.food_id, table.c.nutrient_id, table.c.value]).where(table.c.food_id.in_(food_ids))
+    for food_id, nutrient_id, value in connectable.execute(query):
+        values[food_id][nutrient_id] = value
+    return values
+
+class FoodLoader(object):
+    # Batch loaders of the food rows, complete food profiles and nutrient
+    # values of single foods, e.g. for the request handlers of a threaded
+    # server. Each loader has its own workers, so that up to
+    # max_concurrency connections of connectable are used by each.
+    def __init__(self, connectable, max_batch_size=DEFAULT_MAX_BATCH_SIZE, batch_delay=DEFAULT_BATCH_DELAY,
+                 max_concurrency=DEFAULT_MAX_CONCURRENCY, timeout=None):
+        def create_loader(query):
+            return BatchLoader(lambda food_ids: query(connectable, food_ids), max_batch_size, batch_delay,
+                               max_concurrency, timeout)
+        self.foods = create_loader(query_foods)
+        self.profiles = create_loader(query_food_profiles)
+        self.nutrient_values = create_loader(query_nutrient_values)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def get_food(self, food_id, timeout=None):
+        return self.foods.load(food_id, timeout)
+
+    def get_food_profile(self, food_id, timeout=None):
+        return self.profiles.load(food_id, timeout)
+
+    def get_nutrient_values(self, food_id, timeout=None):
+        return self.nutrient_values.load(food_id, timeout)
+
+    def close(self):
+        for loader in (self.foods, self.profiles, self.nutrient_values):
+            loader.close()
+
+    def stats(self):
+        return {'foods': self.foods.stats(),
+                'profiles': self.profiles.stats(),
+                'nutrient_values': self.nutrient_values.stats()}
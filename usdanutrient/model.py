@@ -1,4 +1,5 @@
-from sqlalchemy import (Table, Column, Boolean, Date, Integer, Numeric, String, ForeignKey)
+from sqlalchemy import (Table, Column, BigInteger, Boolean, Date, DateTime, Float, Index, Integer, Numeric, String,
+                        ForeignKey)
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 
@@ -203,3 +204,72 @@ class FoodNutrientDataSourceMap(Base):
     def __repr__(self):
         return "<FoodNutrientDataSourceMap(food_id='{}', nutrient_id='{}', data_source_id='{}')>".format(
             self.food_id, self.data_source_id, self.data_source)
+
+class ImportFile(Base):
+    __tablename__ = 'import_file'
+
+    # Custom table: content hash of each imported release file, which lets
+    # incremental imports skip the files that did not change.
+    name = Column(String(255), primary_key=True, nullable=False)
+    content_hash = Column(String(40), nullable=False)
+    imported_at = Column(DateTime, nullable=False)
+
+    def __repr__(self):
+        return "<ImportFile(name='{}', content_hash='{}', imported_at='{}')>".format(
+            self.name, self.content_hash, self.imported_at)
+
+class DatasetVersion(Base):
+    __tablename__ = 'dataset_version'
+
+    # Custom table: a single row with a stamp that changes with every
+    # import, which lets caches detect that the data was reloaded.
+    id = Column(Integer, primary_key=True, nullable=False)
+    stamp = Column(String(32), nullable=False)
+    updated_at = Column(DateTime, nullable=False)
+
+    def __repr__(self):
+        return "<DatasetVersion(stamp='{}', updated_at='{}')>".format(
+            self.stamp, self.updated_at)
+
+class GroupNutrientStats(Base):
+    __tablename__ = 'group_nutrient_stats'
+
+    # Custom table: distribution of the values of each nutrient within each
+    # food group, maintained by statsservice. Percentiles are nearest-rank.
+    # The sums fingerprint the rows that the statistics were computed from,
+    # so that a refresh recomputes only the nutrients whose rows changed.
+    group_id = Column(Integer, ForeignKey('food_group.id'), primary_key=True, nullable=False)
+    nutrient_id = Column(Integer, ForeignKey('nutrient.id'), primary_key=True, nullable=False)
+    num_foods = Column(Integer, nullable=False)
+    min_value = Column(Numeric, nullable=False)
+    median_value = Column(Numeric, nullable=False)
+    p90_value = Column(Numeric, nullable=False)
+    max_value = Column(Numeric, nullable=False)
+    food_id_sum = Column(BigInteger, nullable=False)
+    value_sum = Column(Float, nullable=False)
+    weighted_value_sum = Column(Float, nullable=False)
+
+    def __repr__(self):
+        return "<GroupNutrientStats(group_id='{}', nutrient_id='{}', num_foods='{}', median_value='{}')>".format(
+            self.group_id, self.nutrient_id, self.num_foods, self.median_value)
+
+class NutrientRanking(Base):
+    __tablename__ = 'nutrient_ranking'
+
+    # Custom table: the foods of each nutrient sorted by decreasing value,
+    # maintained by statsservice. rank is the position among all the foods,
+    # and group_rank within the food group of the food. food_id has no
+    # foreign key, as the custom import deletes foods before the ranking is
+    # refreshed.
+    nutrient_id = Column(Integer, ForeignKey('nutrient.id'), primary_key=True, nullable=False)
+    rank = Column(Integer, primary_key=True, nullable=False)
+    group_id = Column(Integer, ForeignKey('food_group.id'), nullable=False)
+    group_rank = Column(Integer, nullable=False)
+    food_id = Column(Integer, nullable=False)
+    value = Column(Numeric, nullable=False)
+
+    __table_args__ = (Index('ix_nutrient_ranking_group', 'nutrient_id', 'group_id', 'group_rank'),)
+
+    def __repr__(self):
+        return "<NutrientRanking(nutrient_id='{}', rank='{}', food_id='{}', value='{}')>".format(
+            self.nutrient_id, self.rank, self.food_id, self.value)
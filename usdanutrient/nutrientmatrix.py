@@ -0,0 +1,145 @@
+import json
+import os
+import shutil
+import numpy as np
+from sqlalchemy import select, type_coerce, Float
+import fileservice
+import model
+
+SNAPSHOT_VERSION = 2
+
+# Number of food_nutrient_data rows fetched at a time
+FETCH_SIZE = 100000
+
+def search_ids(ids, keys):
+    # Returns the indexes of keys in the sorted array ids, and whether each
+    # key was found.
+    inds = np.searchsorted(ids, keys)
+    inds[inds == len(ids)] = 0
+    if not len(ids):
+        return inds, np.zeros(len(keys), dtype=np.bool_)
+    return inds, ids[inds] == keys
+
+class NutrientMatrix(object):
+    # Dense food x nutrient matrix of FoodNutrientData.value, in the units
+    # of the nutrient per 100 g of food. The rows follow food_ids and the
+    # columns nutrient_ids, both sorted; mask is True where the food has a
+    # value for the nutrient, and values is 0 elsewhere. Nutrients without
+    # a category have a nutrient_category_id of 0.
+    ARRAY_NAMES = ['food_ids', 'nutrient_ids', 'values', 'mask', 'food_group_ids', 'nutrient_category_ids',
+                   'food_long_descs', 'food_short_descs', 'nutrient_names', 'nutrient_units']
+
+    def __init__(self, arrays):
+        for name in self.ARRAY_NAMES:
+            setattr(self, name, arrays[name])
+
+    def __repr__(self):
+        return "<NutrientMatrix(foods='{}', nutrients='{}', dtype='{}')>".format(
+            len(self.food_ids), len(self.nutrient_ids), self.values.dtype)
+
+    @staticmethod
+    def find(ids, keys, label):
+        keys = np.asarray(keys)
+        inds, found = search_ids(ids, keys)
+        if not np.all(found):
+            raise KeyError("Unknown {} id(s): {}".format(label, ', '.join(str(key) for key in keys[~found])))
+        return inds
+
+    def food_rows(self, food_ids):
+        return self.find(self.food_ids, food_ids, 'food')
+
+    def nutrient_cols(self, nutrient_ids):
+        return self.find(self.nutrient_ids, nutrient_ids, 'nutrient')
+
+    def get_values(self, food_ids, nutrient_ids=None):
+        # Returns the (values, mask) sub-matrices of the foods and nutrients
+        rows = self.food_rows(food_ids)
+        if nutrient_ids is None:
+            return self.values[rows], self.mask[rows]
+        cols = self.nutrient_cols(nutrient_ids)
+        return self.values[np.ix_(rows, cols)], self.mask[np.ix_(rows, cols)]
+
+    def get_profile(self, food_id):
+        # Maps the nutrient ids of the food to their values
+        row = self.food_rows([food_id])[0]
+        cols = np.flatnonzero(self.mask[row])
+        return dict(zip(self.nutrient_ids[cols].tolist(), self.values[row, cols].tolist()))
+
+    def save(self, path):
+        # Each array is saved to its own .npy file, which load_nutrient_matrix
+        # memory-maps. The snapshot is written to a new version directory,
+        # which replace_dir then links path to.
+        tmp_path = fileservice.make_version_dir(path)
+        try:
+            for name in self.ARRAY_NAMES:
+                np.save(os.path.join(tmp_path, name + '.npy'), getattr(self, name))
+            with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+                json.dump({'version': SNAPSHOT_VERSION,
+                           'num_foods': len(self.food_ids),
+                           'num_nutrients': len(self.nutrient_ids),
+                           'dtype': self.values.dtype.name}, f)
+
+            fileservice.replace_dir(tmp_path, path)
+        except:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            raise
+
+def load_nutrient_matrix(path, mmap=True):
+    # With mmap, the arrays are mapped read-only, so that the pages are
+    # shared by all the processes that load the same snapshot. The link of
+    # path is resolved once, so that a concurrent save is never mixed in.
+    path = os.path.realpath(path)
+    with open(os.path.join(path, 'meta.json')) as f:
+        meta = json.load(f)
+    if meta['version'] != SNAPSHOT_VERSION:
+        raise ValueError("Unsupported nutrient matrix snapshot version '{}' in '{}'".format(
+            meta['version'], path))
+
+    mmap_mode = 'r' if mmap else None
+    return NutrientMatrix(dict(
+        (name, np.load(os.path.join(path, name + '.npy'), mmap_mode=mmap_mode))
+        for name in NutrientMatrix.ARRAY_NAMES))
+
+def build_nutrient_matrix(connectable, dtype=np.float32):
+    food_table = model.Food.__table__
+    nutrient_table = model.Nutrient.__table__
+    data_table = model.FoodNutrientData.__table__
+
+    foods = connectable.execute(
+        select([food_table.c.id, food_table.c.long_desc, food_table.c.short_desc, food_table.c.group_id]).
+        order_by(food_table.c.id)).fetchall()
+    nutrients = connectable.execute(
+        select([nutrient_table.c.id, nutrient_table.c.name, nutrient_table.c.units, nutrient_table.c.category_id]).
+        order_by(nutrient_table.c.id)).fetchall()
+
+    arrays = {
+        'food_ids': np.array([row[0] for row in foods], dtype=np.int64),
+        'nutrient_ids': np.array([row[0] for row in nutrients], dtype=np.int64),
+        'food_group_ids': np.array([row[3] for row in foods], dtype=np.int64),
+        'nutrient_category_ids': np.array([row[3] or 0 for row in nutrients], dtype=np.int64),
+        'food_long_descs': np.array([row[1] for row in foods], dtype=np.unicode_),
+        'food_short_descs': np.array([row[2] for row in foods], dtype=np.unicode_),
+        'nutrient_names': np.array([row[1] for row in nutrients], dtype=np.unicode_),
+        'nutrient_units': np.array([row[2] for row in nutrients], dtype=np.unicode_),
+    }
+    values = np.zeros((len(foods), len(nutrients)), dtype=dtype)
+    mask = np.zeros((len(foods), len(nutrients)), dtype=np.bool_)
+
+    # The values are fetched as floats, which is much faster than Decimals
+    result = connectable.execute(
+        select([data_table.c.food_id, data_table.c.nutrient_id, type_coerce(data_table.c.value, Float)]))
+    while True:
+        rows = result.fetchmany(FETCH_SIZE)
+        if not rows:
+            break
+        data = np.array([tuple(row) for row in rows], dtype=np.float64)
+        row_inds, row_found = search_ids(arrays['food_ids'], data[:, 0].astype(np.int64))
+        col_inds, col_found = search_ids(arrays['nutrient_ids'], data[:, 1].astype(np.int64))
+        # Skip the values of foods or nutrients that do not exist
+        found = row_found & col_found
+        values[row_inds[found], col_inds[found]] = data[found, 2]
+        mask[row_inds[found], col_inds[found]] = True
+
+    arrays['values'] = values
+    arrays['mask'] = mask
+    return NutrientMatrix(arrays)
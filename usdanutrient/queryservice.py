@@ -0,0 +1,142 @@
+from collections import namedtuple
+from sqlalchemy import select
+from sqlalchemy.orm import Session, joinedload, selectinload
+import instrumentation
+import model
+
+# Number of foods loaded per query; selectinload loads the related rows of
+# up to 500 parents with each query.
+PROFILE_CHUNK_SIZE = 500
+
+# Number of rows fetched at a time by iter_rows
+FETCH_SIZE = 10000
+
+FoodProfile = namedtuple('FoodProfile', [
+    'id', 'group_id', 'group_name', 'long_desc', 'short_desc', 'common_name', 'sci_name', 'manufacturer',
+    'has_fndds_profile', 'refuse_desc', 'refuse_pct', 'nitrogen_protein_factor', 'protein_calories_factor',
+    'fat_calories_factor', 'carb_calories_factor', 'nutrient_data', 'weights', 'languals'])
+
+NutrientValue = namedtuple('NutrientValue', [
+    'nutrient_id', 'name', 'units', 'num_decimals', 'sr_order', 'category_id', 'value', 'num_data_points',
+    'std_error', 'source_code_id', 'source_code_desc', 'derivation_code_id', 'derivation_code_desc',
+    'missing_food_id', 'is_fortified', 'num_studies', 'min_value', 'max_value', 'degrees_freedom',
+    'lower_95_error_bound', 'upper_95_error_bound', 'stat_comments', 'last_modified', 'confidence_code'])
+
+WeightValue = namedtuple('WeightValue', [
+    'sequence', 'amount', 'measurement_desc', 'grams', 'num_data_points', 'std_dev'])
+
+LangualValue = namedtuple('LangualValue', ['id', 'desc'])
+
+def get_profile_query(session):
+    # Every relationship of the profile is loaded up front, with one query
+    # per relationship for each chunk of foods rather than one per object.
+    # Nutrients and codes are shared by many rows, so they are loaded by
+    # selectinload once each rather than joined to every row.
+    nutrient_data = selectinload(model.Food.nutrient_data)
+    return session.query(model.Food).options(
+        joinedload(model.Food.group),
+        nutrient_data.selectinload(model.FoodNutrientData.nutrient),
+        nutrient_data.selectinload(model.FoodNutrientData.source_code),
+        nutrient_data.selectinload(model.FoodNutrientData.derivation_code),
+        selectinload(model.Food.weights),
+        selectinload(model.Food.languals).joinedload(model.FoodLangualMap.langual))
+
+def to_nutrient_value(data):
+    nutrient = data.nutrient
+    source_code = data.source_code
+    derivation_code = data.derivation_code
+    return NutrientValue(
+        data.nutrient_id, nutrient.name, nutrient.units, nutrient.num_decimals, nutrient.sr_order,
+        nutrient.category_id, data.value, data.num_data_points, data.std_error, data.source_code_id,
+        source_code.desc if source_code else None, data.derivation_code_id,
+        derivation_code.desc if derivation_code else None, data.missing_food_id, data.is_fortified,
+        data.num_studies, data.min_value, data.max_value, data.degrees_freedom, data.lower_95_error_bound,
+        data.upper_95_error_bound, data.stat_comments, data.last_modified, data.confidence_code)
+
+def to_food_profile(food):
+    nutrient_data = sorted([to_nutrient_value(data) for data in food.nutrient_data],
+                           key=lambda value: (value.sr_order, value.nutrient_id))
+    weights = sorted([WeightValue(weight.sequence, weight.amount, weight.measurement_desc, weight.grams,
+                                  weight.num_data_points, weight.std_dev)
+                      for weight in food.weights])
+    languals = sorted([LangualValue(langual_map.langual_id, langual_map.langual.desc)
+                       for langual_map in food.languals])
+    return FoodProfile(
+        food.id, food.group_id, food.group.name, food.long_desc, food.short_desc, food.common_name,
+        food.sci_name, food.manufacturer, food.has_fndds_profile, food.refuse_desc, food.refuse_pct,
+        food.nitrogen_protein_factor, food.protein_calories_factor, food.fat_calories_factor,
+        food.carb_calories_factor, tuple(nutrient_data), tuple(weights), tuple(languals))
+
+@instrumentation.instrumented
+def get_food_profiles(connectable, food_ids):
+    # Returns the FoodProfile of each of food_ids that exists, in the order
+    # of food_ids. The ORM instances are loaded by a private session, which
+    # is discarded once they are converted to read-only tuples.
+    food_ids = list(food_ids)
+    unique_ids = list(set(food_ids))
+    profiles = {}
+    session = Session(bind=connectable)
+    try:
+        for ind in range(0, len(unique_ids), PROFILE_CHUNK_SIZE):
+            chunk = unique_ids[ind:ind + PROFILE_CHUNK_SIZE]
+            for food in get_profile_query(session).filter(model.Food.id.in_(chunk)):
+                profiles[food.id] = to_food_profile(food)
+            session.expunge_all()
+    finally:
+        session.close()
+
+    return [profiles[food_id] for food_id in food_ids if food_id in profiles]
+
+def get_food_profile(connectable, food_id):
+    # Returns the FoodProfile of the food, or None if it does not exist
+    profiles = get_food_profiles(connectable, [food_id])
+    return profiles[0] if profiles else None
+
+_row_types = {}
+
+def get_row_type(table_class):
+    # Named tuple of the columns of the table, e.g. FoodNutrientDataRow.
+    # Tuples have no per-instance dict, instance state or identity map
+    # entry, unlike the instances of the declarative classes.
+    row_type = _row_types.get(table_class)
+    if row_type is None:
+        row_type = namedtuple(table_class.__name__ + 'Row',
+                              [col.key for col in table_class.__table__.columns])
+        _row_types[table_class] = row_type
+    return row_type
+
+def iter_rows(connectable, table_class, whereclause=None, order_by=None):
+    # Streams the rows of the table as read-only named tuples with a Core
+    # select, bypassing the session and its unit of work. order_by is a
+    # list of columns.
+    table = table_class.__table__
+    row_type = get_row_type(table_class)
+    query = select([table])
+    if whereclause is not None:
+        query = query.where(whereclause)
+    if order_by:
+        query = query.order_by(*order_by)
+
+    result = connectable.execute(query)
+    try:
+        while True:
+            rows = result.fetchmany(FETCH_SIZE)
+            if not rows:
+                break
+            for row in rows:
+                yield row_type._make(row)
+    finally:
+        result.close()
+
+@instrumentation.instrumented
+def get_rows(connectable, table_class, whereclause=None, order_by=None):
+    return list(iter_rows(connectable, table_class, whereclause, order_by))
+
+@instrumentation.instrumented
+def get_group_nutrient_data(connectable, group_id):
+    # The nutrient data of all the foods of the food group
+    data_table = model.FoodNutrientData.__table__
+    food_table = model.Food.__table__
+    foods = select([food_table.c.id]).where(food_table.c.group_id == group_id)
+    return get_rows(connectable, model.FoodNutrientData, data_table.c.food_id.in_(foods),
+                    [data_table.c.food_id, data_table.c.nutrient_id])
@@ -0,0 +1,113 @@
+import numpy as np
+from sqlalchemy import select, type_coerce, Float
+import model
+
+# Measurement descriptions of amounts given in grams
+GRAM_MEASURES = (None, '', 'g')
+
+# Number of recipes whose totals are computed with one matrix product
+RECIPE_CHUNK_SIZE = 1000
+
+class WeightIndex(object):
+    # Grams per unit amount of every (food_id, measurement_desc) of the
+    # Weight table, and the refuse percentage of every food.
+    def __init__(self, grams, refuse_pcts):
+        self.grams = grams
+        self.refuse_pcts = refuse_pcts
+
+    def __repr__(self):
+        return "<WeightIndex(weights='{}', foods='{}')>".format(
+            len(self.grams), len(self.refuse_pcts))
+
+    @staticmethod
+    def normalize(measurement_desc):
+        if isinstance(measurement_desc, str):
+            measurement_desc = measurement_desc.decode('utf-8')
+        return measurement_desc.strip()
+
+    def get_grams(self, food_id, measurement_desc, amount, as_purchased=False):
+        # Returns the edible grams of the amount of the food. Household
+        # measures are edible portions; with as_purchased, amounts in grams
+        # include the refuse of the food.
+        if measurement_desc in GRAM_MEASURES:
+            grams = float(amount)
+            if as_purchased:
+                grams *= 1 - self.refuse_pcts.get(food_id, 0) / 100.0
+            return grams
+
+        grams_per_unit = self.grams.get((food_id, self.normalize(measurement_desc)))
+        if grams_per_unit is None:
+            raise KeyError("Unknown measurement '{}' of food '{}'".format(measurement_desc, food_id))
+        return grams_per_unit * float(amount)
+
+def build_weight_index(connectable):
+    weight_table = model.Weight.__table__
+    food_table = model.Food.__table__
+
+    # Weights are ordered by sequence, so the first weight of a food with
+    # the measurement description wins.
+    grams = {}
+    query = select([weight_table.c.food_id, weight_table.c.measurement_desc,
+                    type_coerce(weight_table.c.amount, Float), type_coerce(weight_table.c.grams, Float)]).\
+        order_by(weight_table.c.food_id, weight_table.c.sequence)
+    for food_id, measurement_desc, amount, weight_grams in connectable.execute(query):
+        if amount:
+            grams.setdefault((food_id, WeightIndex.normalize(measurement_desc)), weight_grams / amount)
+
+    refuse_pcts = dict(connectable.execute(
+        select([food_table.c.id, food_table.c.refuse_pct]).
+        where(food_table.c.refuse_pct != None)).fetchall())
+    return WeightIndex(grams, refuse_pcts)
+
+def resolve_recipe_lines(weight_index, recipes, as_purchased=False):
+    # Flattens the (food_id, measurement_desc, amount) lines of the recipes
+    # into arrays of recipe indexes, food ids and edible grams.
+    recipe_inds = []
+    food_ids = []
+    grams = []
+    for recipe_ind, lines in enumerate(recipes):
+        for food_id, measurement_desc, amount in lines:
+            recipe_inds.append(recipe_ind)
+            food_ids.append(food_id)
+            grams.append(weight_index.get_grams(food_id, measurement_desc, amount, as_purchased))
+
+    return (np.array(recipe_inds, dtype=np.int64),
+            np.array(food_ids, dtype=np.int64),
+            np.array(grams, dtype=np.float64))
+
+def compute_recipe_totals(matrix, weight_index, recipes, nutrient_ids=None, as_purchased=False):
+    # Returns the (totals, complete) matrices of the recipes x nutrients of
+    # the nutrient matrix, or of nutrient_ids. complete is False where a
+    # food of the recipe has no value for the nutrient, which then counts
+    # as 0 in the total.
+    recipe_inds, food_ids, grams = resolve_recipe_lines(weight_index, recipes, as_purchased)
+    rows = matrix.food_rows(food_ids)
+    if nutrient_ids is None:
+        cols = np.arange(len(matrix.nutrient_ids))
+    else:
+        cols = matrix.nutrient_cols(nutrient_ids)
+
+    totals = np.zeros((len(recipes), len(cols)), dtype=np.float64)
+    complete = np.ones((len(recipes), len(cols)), dtype=np.bool_)
+
+    # The values are per 100 g. Each chunk of recipes is a dense
+    # recipes x foods matrix of hundreds of grams over the foods that the
+    # chunk uses, multiplied with the values of those foods.
+    for start in range(0, len(recipes), RECIPE_CHUNK_SIZE):
+        end = min(start + RECIPE_CHUNK_SIZE, len(recipes))
+        lo, hi = np.searchsorted(recipe_inds, [start, end])
+        if lo == hi:
+            continue
+
+        chunk_rows, food_inds = np.unique(rows[lo:hi], return_inverse=True)
+        amounts = np.zeros((end - start, len(chunk_rows)), dtype=np.float64)
+        np.add.at(amounts, (recipe_inds[lo:hi] - start, food_inds), grams[lo:hi] / 100.0)
+
+        values = matrix.values[np.ix_(chunk_rows, cols)].astype(np.float64)
+        missing = ~matrix.mask[np.ix_(chunk_rows, cols)]
+        totals[start:end] = amounts.dot(values)
+        uses = np.zeros((end - start, len(chunk_rows)), dtype=np.float64)
+        uses[recipe_inds[lo:hi] - start, food_inds] = 1
+        complete[start:end] = uses.dot(missing) == 0
+
+    return totals, complete
@@ -0,0 +1,233 @@
+import bisect
+import cPickle
+import os
+import re
+import tempfile
+from sqlalchemy import select
+import fileservice
+import model
+
+INDEX_VERSION = 1
+
+# Weight of a match in each field of a food
+FIELD_WEIGHTS = [
+    ('long_desc', 1.0),
+    ('common_name', 0.8),
+    ('short_desc', 0.6),
+    ('manufacturer', 0.5),
+]
+
+# Weight of a query token that is a prefix of, or similar to, an indexed
+# token, relative to an exact match
+PREFIX_WEIGHT = 0.8
+FUZZY_WEIGHT = 0.6
+
+# Minimum trigram similarity of a fuzzy match
+FUZZY_MIN_SIMILARITY = 0.4
+
+# Maximum number of indexed tokens that a query token expands to
+MAX_EXPANSIONS = 50
+
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+def tokenize(text):
+    if not text:
+        return []
+    if isinstance(text, str):
+        text = text.decode('utf-8')
+    return TOKEN_RE.findall(text.lower())
+
+def get_trigrams(token):
+    padded = u'  ' + token + u' '
+    return set(padded[ind:ind + 3] for ind in range(len(padded) - 2))
+
+class FoodSearchIndex(object):
+    # Inverted index of the descriptions of foods. postings maps each token
+    # to {food_id: weight of the best field that contains it}, trigrams
+    # maps each trigram to the set of tokens that contain it, and tokens is
+    # the sorted vocabulary, for prefix queries.
+    def __init__(self):
+        self.foods = {}
+        self.postings = {}
+        self.trigrams = {}
+        self.tokens = []
+
+    def __repr__(self):
+        return "<FoodSearchIndex(foods='{}', tokens='{}')>".format(
+            len(self.foods), len(self.tokens))
+
+    @staticmethod
+    def get_food_tokens(fields):
+        weights = {}
+        for (field_name, field_weight), text in zip(FIELD_WEIGHTS, fields):
+            for token in tokenize(text):
+                if weights.get(token, 0) < field_weight:
+                    weights[token] = field_weight
+        return weights
+
+    def add_token(self, token):
+        self.postings[token] = {}
+        bisect.insort(self.tokens, token)
+        for trigram in get_trigrams(token):
+            self.trigrams.setdefault(trigram, set()).add(token)
+
+    def remove_token(self, token):
+        del self.postings[token]
+        del self.tokens[bisect.bisect_left(self.tokens, token)]
+        for trigram in get_trigrams(token):
+            tokens = self.trigrams[trigram]
+            tokens.discard(token)
+            if not tokens:
+                del self.trigrams[trigram]
+
+    def add_food(self, food_id, group_id, fields):
+        # fields are the texts of the FIELD_WEIGHTS columns of the food
+        if food_id in self.foods:
+            self.remove_food(food_id)
+        self.foods[food_id] = (group_id, tuple(fields))
+        for token, weight in self.get_food_tokens(fields).items():
+            if token not in self.postings:
+                self.add_token(token)
+            self.postings[token][food_id] = weight
+
+    def remove_food(self, food_id):
+        group_id, fields = self.foods.pop(food_id)
+        for token in self.get_food_tokens(fields):
+            postings = self.postings[token]
+            del postings[food_id]
+            if not postings:
+                self.remove_token(token)
+
+    def expand_prefix(self, prefix):
+        ind = bisect.bisect_left(self.tokens, prefix)
+        matches = []
+        while (ind < len(self.tokens) and len(matches) < MAX_EXPANSIONS
+               and self.tokens[ind].startswith(prefix)):
+            matches.append(self.tokens[ind])
+            ind += 1
+        return matches
+
+    def expand_fuzzy(self, token):
+        # Indexed tokens ranked by the Jaccard similarity of their trigrams
+        trigrams = get_trigrams(token)
+        counts = {}
+        for trigram in trigrams:
+            for candidate in self.trigrams.get(trigram, ()):
+                counts[candidate] = counts.get(candidate, 0) + 1
+
+        matches = []
+        for candidate, count in counts.items():
+            similarity = float(count) / (len(trigrams) + len(get_trigrams(candidate)) - count)
+            if similarity >= FUZZY_MIN_SIMILARITY:
+                matches.append((similarity, candidate))
+        matches.sort(reverse=True)
+        return matches[:MAX_EXPANSIONS]
+
+    def match_token(self, token, prefix, fuzzy):
+        # Maps the food ids that match the query token to their scores
+        expansions = {}
+        if token in self.postings:
+            expansions[token] = 1.0
+        if prefix:
+            for match in self.expand_prefix(token):
+                expansions.setdefault(match, PREFIX_WEIGHT)
+        if fuzzy and not expansions and len(token) >= 3:
+            for similarity, match in self.expand_fuzzy(token):
+                expansions.setdefault(match, FUZZY_WEIGHT * similarity)
+
+        scores = {}
+        for match, match_weight in expansions.items():
+            for food_id, weight in self.postings[match].items():
+                score = match_weight * weight
+                if scores.get(food_id, 0) < score:
+                    scores[food_id] = score
+        return scores
+
+    def search(self, query, limit=10, group_ids=None, prefix=True, fuzzy=True):
+        # Returns the (food_id, score) of the best foods that match every
+        # token of the query. The last token of the query is also matched
+        # as a prefix, and tokens without an exact or prefix match are
+        # matched approximately.
+        tokens = tokenize(query)
+        if not tokens:
+            return []
+
+        scores = None
+        for ind, token in enumerate(tokens):
+            token_scores = self.match_token(token, prefix and ind == len(tokens) - 1, fuzzy)
+            if scores is None:
+                scores = token_scores
+            else:
+                scores = dict((food_id, score + token_scores[food_id])
+                              for food_id, score in scores.items() if food_id in token_scores)
+            if not scores:
+                return []
+
+        if group_ids is not None:
+            group_ids = set(group_ids)
+            scores = dict((food_id, score) for food_id, score in scores.items()
+                          if self.foods[food_id][0] in group_ids)
+
+        # Ties are broken by the shortest long description
+        ranked = sorted(scores.items(), key=lambda item: (-item[1], len(self.foods[item[0]][1][0]), item[0]))
+        return ranked[:limit]
+
+    def sync(self, connectable):
+        # Index the foods that were added or changed since the index was
+        # built, and drop the foods that were deleted. Returns the number of
+        # foods that were reindexed or removed.
+        food_table = model.Food.__table__
+        query = select([food_table.c.id, food_table.c.group_id] +
+                       [food_table.c[field_name] for field_name, weight in FIELD_WEIGHTS])
+
+        num_changes = 0
+        food_ids = set()
+        for row in connectable.execute(query):
+            food_id, group_id, fields = row[0], row[1], tuple(row[2:])
+            food_ids.add(food_id)
+            if self.foods.get(food_id) != (group_id, fields):
+                self.add_food(food_id, group_id, fields)
+                num_changes += 1
+
+        for food_id in set(self.foods) - food_ids:
+            self.remove_food(food_id)
+            num_changes += 1
+        return num_changes
+
+    def save(self, path):
+        # The index is written to a temporary file that then replaces path,
+        # so readers never see a partial index.
+        fd, tmp_path = tempfile.mkstemp(prefix='.searchindex-', dir=os.path.dirname(os.path.abspath(path)))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                cPickle.dump((INDEX_VERSION, self.foods, self.postings, self.trigrams, self.tokens),
+                             f, cPickle.HIGHEST_PROTOCOL)
+            # mkstemp creates the file for its owner only
+            os.chmod(tmp_path, 0o666 & ~fileservice.get_umask())
+            os.rename(tmp_path, path)
+        except:
+            os.remove(tmp_path)
+            raise
+
+def load_search_index(path):
+    with open(path, 'rb') as f:
+        data = cPickle.load(f)
+    if data[0] != INDEX_VERSION:
+        raise ValueError("Unsupported search index version '{}' in '{}'".format(data[0], path))
+
+    index = FoodSearchIndex()
+    index.foods, index.postings, index.trigrams, index.tokens = data[1:]
+    return index
+
+def update_search_index(connectable, path):
+    # Builds the index of path, or brings an existing one up to date with
+    # the food table.
+    if os.path.exists(path):
+        index = load_search_index(path)
+    else:
+        index = FoodSearchIndex()
+    num_changes = index.sync(connectable)
+    if num_changes or not os.path.exists(path):
+        index.save(path)
+    print("Updated {} foods of the search index '{}'".format(num_changes, path))
+    return index
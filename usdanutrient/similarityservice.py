@@ -0,0 +1,201 @@
+import numpy as np
+
+METRICS = ('cosine', 'euclidean')
+
+# Number of query foods whose distances are computed with one matrix product
+QUERY_BLOCK_SIZE = 256
+
+INDEX_VERSION = 2
+
+class SimilarityEngine(object):
+    # Nearest neighbour search over the nutrient profiles of the nutrient
+    # matrix. Each nutrient is standardized over the foods that have a
+    # value for it, and missing values are set to the mean of the nutrient.
+    # weights maps nutrient ids to their weights, 1 by default, and each
+    # nutrient is scaled by the square root of its weight; with the cosine
+    # metric the vectors are then scaled to unit length. Distances are 1 -
+    # the weighted cosine similarity, or the weighted euclidean distance.
+    # Foods without a value for any of the nutrients are never neighbours.
+    def __init__(self, matrix, nutrient_ids=None, category_ids=None, metric='cosine', weights=None):
+        if metric not in METRICS:
+            raise ValueError("Unknown metric '{}'; expected one of: {}".format(metric, ', '.join(METRICS)))
+
+        if nutrient_ids is not None:
+            cols = matrix.nutrient_cols(nutrient_ids)
+        else:
+            cols = np.arange(len(matrix.nutrient_ids))
+        if category_ids is not None:
+            cols = cols[np.in1d(matrix.nutrient_category_ids[cols], category_ids)]
+
+        self.matrix = matrix
+        self.metric = metric
+        self.nutrient_ids = matrix.nutrient_ids[cols]
+        self.weights = self.get_weights(matrix, cols, weights)
+        self.vectors = self.normalize(matrix.values[:, cols], matrix.mask[:, cols])
+        self.has_values = matrix.mask[:, cols].any(axis=1)
+        self.sq_norms = np.einsum('ij,ij->i', self.vectors, self.vectors)
+        self.centroids = None
+        self.list_offsets = None
+        self.list_rows = None
+
+    def __repr__(self):
+        return "<SimilarityEngine(foods='{}', nutrients='{}', metric='{}')>".format(
+            len(self.vectors), len(self.nutrient_ids), self.metric)
+
+    @staticmethod
+    def get_weights(matrix, cols, weights):
+        # The weights of the nutrients of cols; weights of other nutrients
+        # are ignored
+        if weights is None:
+            return None
+        all_weights = np.ones(len(matrix.nutrient_ids))
+        nutrient_ids = list(weights)
+        all_weights[matrix.nutrient_cols(nutrient_ids)] = [weights[nutrient_id] for nutrient_id in nutrient_ids]
+        if np.any(all_weights < 0):
+            raise ValueError("Nutrient weights must not be negative")
+        return all_weights[cols]
+
+    def normalize(self, values, mask):
+        values = values.astype(np.float64)
+        counts = np.maximum(mask.sum(axis=0), 1)
+        means = np.where(mask, values, 0).sum(axis=0) / counts
+        stds = np.sqrt(np.where(mask, (values - means) ** 2, 0).sum(axis=0) / counts)
+        stds[stds == 0] = 1
+        vectors = np.where(mask, (values - means) / stds, 0)
+
+        if self.weights is not None:
+            vectors *= np.sqrt(self.weights)
+        if self.metric == 'cosine':
+            norms = np.sqrt(np.einsum('ij,ij->i', vectors, vectors))
+            norms[norms == 0] = 1
+            vectors /= norms[:, np.newaxis]
+        return vectors.astype(np.float32)
+
+    def get_distances(self, query_rows, candidate_rows):
+        # Returns the query x candidate matrix of distances
+        products = self.vectors[query_rows].dot(self.vectors[candidate_rows].T)
+        if self.metric == 'cosine':
+            return 1 - products
+        distances = self.sq_norms[query_rows][:, np.newaxis] + self.sq_norms[candidate_rows] - 2 * products
+        return np.sqrt(np.maximum(distances, 0))
+
+    def get_candidate_rows(self, group_ids):
+        if group_ids is None:
+            return np.flatnonzero(self.has_values)
+        return np.flatnonzero(self.has_values & np.in1d(self.matrix.food_group_ids, group_ids))
+
+    def top_k(self, distances, candidate_rows, query_rows, k):
+        # Returns the food ids and distances of the k nearest candidates of
+        # each query row. A food is never its own neighbour: its distance
+        # is inf, and such entries are returned as food id -1.
+        distances[query_rows[:, np.newaxis] == candidate_rows] = np.inf
+        inds = np.argpartition(distances, k - 1, axis=1)[:, :k]
+        query_inds = np.arange(len(distances))[:, np.newaxis]
+        order = np.argsort(distances[query_inds, inds], axis=1)
+        inds = inds[query_inds, order]
+        distances = distances[query_inds, inds]
+        return np.where(np.isinf(distances), -1, self.matrix.food_ids[candidate_rows[inds]]), distances
+
+    def search(self, food_ids, k=10, group_ids=None, approximate=False, num_probe=8):
+        # Returns the (food_ids, distances) matrices of the k nearest foods of
+        # each of food_ids, nearest first, optionally restricted to the foods
+        # of group_ids. Neighbours that are missing, e.g. when there are
+        # fewer than k candidates, are padded with food id -1 and a distance
+        # of inf. With approximate, only the foods of the num_probe lists of
+        # the index nearest to each query food are searched.
+        query_rows = self.matrix.food_rows(food_ids)
+        if approximate:
+            if self.centroids is None:
+                raise ValueError("No approximate index; call build_index or load_index first")
+            return self.search_approximate(query_rows, k, group_ids, num_probe)
+
+        candidate_rows = self.get_candidate_rows(group_ids)
+        # If every query food is a candidate, each has one candidate less
+        k = min(k, len(candidate_rows) - int(np.in1d(query_rows, candidate_rows).all()))
+        neighbours = np.full((len(query_rows), max(k, 0)), -1, dtype=np.int64)
+        distances = np.full((len(query_rows), max(k, 0)), np.inf, dtype=np.float32)
+        if k <= 0:
+            return neighbours, distances
+
+        for start in range(0, len(query_rows), QUERY_BLOCK_SIZE):
+            block_rows = query_rows[start:start + QUERY_BLOCK_SIZE]
+            neighbours[start:start + len(block_rows)], distances[start:start + len(block_rows)] = self.top_k(
+                self.get_distances(block_rows, candidate_rows), candidate_rows, block_rows, k)
+        return neighbours, distances
+
+    def search_approximate(self, query_rows, k, group_ids, num_probe):
+        num_probe = min(num_probe, len(self.centroids))
+        centroid_distances = (np.einsum('ij,ij->i', self.centroids, self.centroids)
+                              - 2 * self.vectors[query_rows].dot(self.centroids.T))
+        probes = np.argpartition(centroid_distances, num_probe - 1, axis=1)[:, :num_probe]
+        group_mask = None if group_ids is None else np.in1d(self.matrix.food_group_ids, group_ids)
+
+        neighbours = np.full((len(query_rows), k), -1, dtype=np.int64)
+        distances = np.full((len(query_rows), k), np.inf, dtype=np.float32)
+        for ind, query_row in enumerate(query_rows):
+            candidate_rows = np.concatenate([self.list_rows[self.list_offsets[probe]:self.list_offsets[probe + 1]]
+                                             for probe in probes[ind]])
+            candidate_rows = candidate_rows[self.has_values[candidate_rows] & (candidate_rows != query_row)]
+            if group_mask is not None:
+                candidate_rows = candidate_rows[group_mask[candidate_rows]]
+            num_neighbours = min(k, len(candidate_rows))
+            if not num_neighbours:
+                continue
+            neighbours[ind, :num_neighbours], distances[ind, :num_neighbours] = self.top_k(
+                self.get_distances(query_rows[ind:ind + 1], candidate_rows), candidate_rows,
+                query_rows[ind:ind + 1], num_neighbours)
+        return neighbours, distances
+
+    def build_index(self, num_lists=None, iterations=10, seed=0):
+        # Approximate index: the foods are clustered with k-means into
+        # num_lists inverted lists, by default about the square root of the
+        # number of foods.
+        if num_lists is None:
+            num_lists = max(1, int(np.sqrt(len(self.vectors))))
+        random = np.random.RandomState(seed)
+        centroids = self.vectors[random.choice(len(self.vectors), num_lists, replace=False)].astype(np.float64)
+        for _ in range(iterations):
+            assignments = self.assign(centroids)
+            for list_ind in range(num_lists):
+                members = self.vectors[assignments == list_ind]
+                if len(members):
+                    centroids[list_ind] = members.mean(axis=0)
+
+        assignments = self.assign(centroids)
+        self.centroids = centroids.astype(np.float32)
+        self.list_rows = np.argsort(assignments, kind='mergesort')
+        self.list_offsets = np.searchsorted(assignments[self.list_rows], np.arange(num_lists + 1))
+
+    def assign(self, centroids):
+        distances = np.einsum('ij,ij->i', centroids, centroids) - 2 * self.vectors.dot(centroids.T)
+        return np.argmin(distances, axis=1)
+
+    def save_index(self, path):
+        # The index is only valid for the foods, nutrients, weights and
+        # metric of the engine that built it.
+        with open(path, 'wb') as f:
+            np.savez(f, version=INDEX_VERSION, food_ids=self.matrix.food_ids, nutrient_ids=self.nutrient_ids,
+                     metric=self.metric, weights=self.get_index_weights(), centroids=self.centroids,
+                     list_offsets=self.list_offsets, list_rows=self.list_rows)
+
+    def get_index_weights(self):
+        if self.weights is None:
+            return np.ones(len(self.nutrient_ids))
+        return self.weights
+
+    def load_index(self, path):
+        data = np.load(path)
+        try:
+            if int(data['version']) != INDEX_VERSION:
+                raise ValueError("Unsupported similarity index version '{}' in '{}'".format(
+                    int(data['version']), path))
+            if (str(data['metric']) != self.metric
+                    or not np.array_equal(data['food_ids'], self.matrix.food_ids)
+                    or not np.array_equal(data['nutrient_ids'], self.nutrient_ids)
+                    or not np.array_equal(data['weights'], self.get_index_weights())):
+                raise ValueError("Similarity index '{}' does not match the engine {}".format(path, self))
+            self.centroids = data['centroids']
+            self.list_offsets = data['list_offsets']
+            self.list_rows = data['list_rows']
+        finally:
+            data.close()
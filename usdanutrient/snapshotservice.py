@@ -0,0 +1,156 @@
+import itertools
+import json
+import os
+import shutil
+import time
+import numpy as np
+from sqlalchemy import select, Boolean, Date, DateTime, Integer, Numeric
+import bulkloader
+import importservice
+import fileservice
+import model
+import queryservice
+import statsservice
+
+SNAPSHOT_VERSION = 1
+
+# Number of rows fetched at a time by the export
+FETCH_SIZE = 100000
+
+# Column types and their null values; String columns are stored as unicode
+COLUMN_DTYPES = {
+    Integer: (np.int64, 0),
+    Numeric: (np.float64, np.nan),
+    Boolean: (np.bool_, False),
+    Date: ('datetime64[D]', None),
+    DateTime: ('datetime64[us]', None),
+}
+
+def get_column_dtype(col):
+    return COLUMN_DTYPES.get(type(col.type), (np.unicode_, u''))
+
+def encode_column(col, values):
+    # Returns the array of the values, and the mask of the null values, if
+    # any. Numeric values are stored as floats.
+    dtype, null_value = get_column_dtype(col)
+    nulls = np.array([value is None for value in values], dtype=np.bool_)
+    if null_value is None:
+        array = np.array(values, dtype=dtype)
+    else:
+        array = np.array([null_value if value is None else value for value in values], dtype=dtype)
+    return array, (nulls if nulls.any() else None)
+
+def decode_column(array, nulls):
+    # tolist converts the values to Python ints, floats, unicode strings,
+    # dates and datetimes without formatting and parsing them as text.
+    values = array.tolist()
+    if nulls is not None:
+        for ind in np.flatnonzero(nulls).tolist():
+            values[ind] = None
+    return values
+
+def export_table(connectable, table_class, fname):
+    table = table_class.__table__
+    columns = dict((col.name, []) for col in table.columns)
+    col_names = [col.name for col in table.columns]
+    result = connectable.execute(select([table]).order_by(*table.primary_key.columns))
+    while True:
+        rows = result.fetchmany(FETCH_SIZE)
+        if not rows:
+            break
+        for row in rows:
+            for col_name, value in zip(col_names, row):
+                columns[col_name].append(value)
+
+    arrays = {}
+    for col in table.columns:
+        array, nulls = encode_column(col, columns.pop(col.name))
+        arrays[col.name] = array
+        if nulls is not None:
+            arrays[col.name + '.null'] = nulls
+    with open(fname, 'wb') as f:
+        np.savez_compressed(f, **arrays)
+    return len(arrays[col_names[0]])
+
+def export_snapshot(connectable, path):
+    # Saves every table of the model to a compressed .npz file of typed
+    # column arrays. The snapshot is written to a new version directory,
+    # which path is then linked to, like the snapshots of the nutrient
+    # matrix.
+    tmp_path = fileservice.make_version_dir(path)
+    try:
+        tables = {}
+        for table_class in importservice.get_model_classes():
+            start = time.time()
+            num_rows = export_table(connectable, table_class,
+                                    os.path.join(tmp_path, table_class.__tablename__ + '.npz'))
+            tables[table_class.__tablename__] = num_rows
+            print("Exported {} rows of '{}' in {:.2f}s".format(
+                num_rows, table_class.__tablename__, time.time() - start))
+
+        with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+            json.dump({'version': SNAPSHOT_VERSION, 'tables': tables}, f)
+
+        fileservice.replace_dir(tmp_path, path)
+    except:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        raise
+
+def read_snapshot_meta(path):
+    with open(os.path.join(path, 'meta.json')) as f:
+        meta = json.load(f)
+    if meta['version'] != SNAPSHOT_VERSION:
+        raise ValueError("Unsupported snapshot version '{}' in '{}'".format(meta['version'], path))
+    return meta
+
+def read_snapshot_columns(path, table_class):
+    # Returns the columns of the table in the snapshot, in the order of the
+    # columns of the model.
+    table = table_class.__table__
+    data = np.load(os.path.join(path, table.name + '.npz'))
+    try:
+        return [decode_column(data[col.name], data[col.name + '.null'] if col.name + '.null' in data.files else None)
+                for col in table.columns]
+    finally:
+        data.close()
+
+def iter_snapshot_rows(path, table_class):
+    # Serves the rows of a table of the snapshot as the read-only named
+    # tuples of queryservice, without a database.
+    path = os.path.realpath(path)
+    read_snapshot_meta(path)
+    row_type = queryservice.get_row_type(table_class)
+    for row in itertools.izip(*read_snapshot_columns(path, table_class)):
+        yield row_type._make(row)
+
+def load_snapshot(engine, path, batch_size=importservice.DEFAULT_BATCH_SIZE, bulk_load=True):
+    # Replaces the tables with those of the snapshot, which are loaded with
+    # the same bulk loaders as the release files. The link of path is
+    # resolved once, so that a concurrent export is never mixed in.
+    path = os.path.realpath(path)
+    meta = read_snapshot_meta(path)
+    table_classes = importservice.get_model_classes()
+    for table_class in reversed(table_classes):
+        table_class.__table__.drop(engine, checkfirst=True)
+    for table_class in table_classes:
+        table_class.__table__.create(engine)
+
+    for table_class in table_classes:
+        if table_class.__tablename__ not in meta['tables']:
+            print("No file for table '{}' in snapshot '{}'".format(table_class.__tablename__, path))
+            continue
+
+        start = time.time()
+        columns = read_snapshot_columns(path, table_class)
+        col_order = [col.name for col in table_class.__table__.columns]
+        num_rows = bulkloader.load_rows(engine, table_class.__table__, col_order,
+                                        lambda: itertools.izip(*columns), batch_size, bulk_load)
+        elapsed = time.time() - start
+        print("Loaded {} rows into '{}' in {:.2f}s ({:.0f} rows/s)".format(
+            num_rows, table_class.__tablename__, elapsed, num_rows / elapsed if elapsed else 0))
+
+    # The loaded data replaces whatever was cached before, and the
+    # statistics are recomputed if the snapshot has none, or stale ones
+    with engine.begin() as conn:
+        statsservice.refresh_nutrient_stats(conn)
+        importservice.bump_dataset_version(conn)
@@ -0,0 +1,189 @@
+import itertools
+import math
+import time
+from sqlalchemy import and_, func, select, type_coerce, Float
+import bulkloader
+import model
+import queryservice
+
+# Number of nutrients whose rows are fetched, ranked and inserted at a
+# time, which bounds the rows held in memory
+NUTRIENT_CHUNK_SIZE = 10
+
+# Maximum number of values in the IN clause of a delete
+DELETE_CHUNK_SIZE = 500
+
+# Number of rows inserted per batch
+INSERT_BATCH_SIZE = 10000
+
+# Relative tolerance of the comparison of the float sums of fingerprints,
+# which the database may add up in any order
+FINGERPRINT_TOLERANCE = 1e-9
+
+def get_percentile_index(num_values, pct):
+    # Nearest-rank percentile: the index of the value within values sorted
+    # by decreasing value, as they are ranked
+    rank = max(1, int(math.ceil(num_values * pct / 100.0)))
+    return num_values - rank
+
+def get_fingerprints(conn):
+    # Maps each nutrient id to a dict of the fingerprints of its rows within
+    # each food group, i.e. the number of foods, the sum of their ids, the
+    # sum of their values and the sum of their values weighted by their ids
+    data_table = model.FoodNutrientData.__table__
+    food_table = model.Food.__table__
+    value = type_coerce(data_table.c.value, Float)
+    query = select([data_table.c.nutrient_id, food_table.c.group_id, func.count(), func.sum(data_table.c.food_id),
+                    func.sum(value), func.sum(value * data_table.c.food_id)]).\
+        select_from(data_table.join(food_table, data_table.c.food_id == food_table.c.id)).\
+        group_by(data_table.c.nutrient_id, food_table.c.group_id)
+    fingerprints = {}
+    for nutrient_id, group_id, num_foods, food_id_sum, value_sum, weighted_value_sum in conn.execute(query):
+        fingerprints.setdefault(nutrient_id, {})[group_id] = (
+            num_foods, int(food_id_sum), float(value_sum), float(weighted_value_sum))
+    return fingerprints
+
+def get_stored_fingerprints(conn):
+    table = model.GroupNutrientStats.__table__
+    query = select([table.c.nutrient_id, table.c.group_id, table.c.num_foods, table.c.food_id_sum,
+                    table.c.value_sum, table.c.weighted_value_sum])
+    fingerprints = {}
+    for nutrient_id, group_id, num_foods, food_id_sum, value_sum, weighted_value_sum in conn.execute(query):
+        fingerprints.setdefault(nutrient_id, {})[group_id] = (
+            num_foods, int(food_id_sum), float(value_sum), float(weighted_value_sum))
+    return fingerprints
+
+def fingerprints_match(fingerprints, other_fingerprints):
+    if set(fingerprints) != set(other_fingerprints):
+        return False
+    for group_id, (num_foods, food_id_sum, value_sum, weighted_value_sum) in fingerprints.items():
+        other = other_fingerprints[group_id]
+        if (num_foods, food_id_sum) != other[:2]:
+            return False
+        for total, other_total in zip((value_sum, weighted_value_sum), other[2:]):
+            if abs(total - other_total) > FINGERPRINT_TOLERANCE * max(1.0, abs(total), abs(other_total)):
+                return False
+    return True
+
+def get_nutrient_rows(conn, nutrient_ids):
+    # Returns (nutrient_id, rows) with the (value, food_id, group_id) rows of
+    # each nutrient sorted by decreasing value, and then by food id
+    data_table = model.FoodNutrientData.__table__
+    food_table = model.Food.__table__
+    query = select([data_table.c.nutrient_id, data_table.c.value, data_table.c.food_id, food_table.c.group_id]).\
+        select_from(data_table.join(food_table, data_table.c.food_id == food_table.c.id)).\
+        where(data_table.c.nutrient_id.in_(nutrient_ids)).\
+        order_by(data_table.c.nutrient_id, data_table.c.value.desc(), data_table.c.food_id)
+    return [(nutrient_id, [tuple(row[1:]) for row in rows])
+            for nutrient_id, rows in itertools.groupby(conn.execute(query).fetchall(), lambda row: row[0])]
+
+def compute_nutrient_stats(nutrient_id, rows, fingerprints):
+    # Returns the ranking rows and the group statistics rows of a nutrient
+    # from its sorted rows
+    ranking = []
+    group_values = {}
+    for rank, (value, food_id, group_id) in enumerate(rows, 1):
+        values = group_values.setdefault(group_id, [])
+        values.append(value)
+        ranking.append({'nutrient_id': nutrient_id, 'rank': rank, 'group_id': group_id,
+                        'group_rank': len(values), 'food_id': food_id, 'value': value})
+
+    stats = []
+    for group_id, values in group_values.items():
+        num_foods, food_id_sum, value_sum, weighted_value_sum = fingerprints[group_id]
+        stats.append({'group_id': group_id,
+                      'nutrient_id': nutrient_id,
+                      'num_foods': len(values),
+                      'min_value': values[-1],
+                      'median_value': values[get_percentile_index(len(values), 50)],
+                      'p90_value': values[get_percentile_index(len(values), 90)],
+                      'max_value': values[0],
+                      'food_id_sum': food_id_sum,
+                      'value_sum': value_sum,
+                      'weighted_value_sum': weighted_value_sum})
+    return ranking, stats
+
+def refresh_nutrient_stats(conn):
+    # Brings the group_nutrient_stats and nutrient_ranking tables up to
+    # date with the nutrient data, within the transaction of conn, which
+    # may also be a session. Only the nutrients whose rows changed since
+    # the last refresh, e.g. those of the foods of a custom import, are
+    # recomputed. Returns the number of recomputed nutrients.
+    start = time.time()
+    fingerprints = get_fingerprints(conn)
+    stored_fingerprints = get_stored_fingerprints(conn)
+    nutrient_ids = sorted(nutrient_id for nutrient_id in set(fingerprints) | set(stored_fingerprints)
+                          if not fingerprints_match(fingerprints.get(nutrient_id, {}),
+                                                    stored_fingerprints.get(nutrient_id, {})))
+    num_changed = len(nutrient_ids)
+    if not num_changed:
+        return 0
+
+    stats_table = model.GroupNutrientStats.__table__
+    ranking_table = model.NutrientRanking.__table__
+    if num_changed == len(set(fingerprints) | set(stored_fingerprints)):
+        conn.execute(stats_table.delete())
+        conn.execute(ranking_table.delete())
+    else:
+        for ind in range(0, len(nutrient_ids), DELETE_CHUNK_SIZE):
+            chunk = nutrient_ids[ind:ind + DELETE_CHUNK_SIZE]
+            conn.execute(stats_table.delete().where(stats_table.c.nutrient_id.in_(chunk)))
+            conn.execute(ranking_table.delete().where(ranking_table.c.nutrient_id.in_(chunk)))
+
+    # Nutrients without rows are only deleted
+    nutrient_ids = [nutrient_id for nutrient_id in nutrient_ids if nutrient_id in fingerprints]
+    for ind in range(0, len(nutrient_ids), NUTRIENT_CHUNK_SIZE):
+        ranking = []
+        stats = []
+        for nutrient_id, rows in get_nutrient_rows(conn, nutrient_ids[ind:ind + NUTRIENT_CHUNK_SIZE]):
+            nutrient_ranking, nutrient_stats = compute_nutrient_stats(nutrient_id, rows, fingerprints[nutrient_id])
+            ranking.extend(nutrient_ranking)
+            stats.extend(nutrient_stats)
+        for table, rows in ((stats_table, stats), (ranking_table, ranking)):
+            for batch in bulkloader.iter_batches(rows, INSERT_BATCH_SIZE):
+                conn.execute(table.insert(), batch)
+
+    print("Refreshed the statistics of {} nutrients in {:.2f}s".format(num_changed, time.time() - start))
+    return num_changed
+
+def get_group_nutrient_stats(conn, group_id, nutrient_id):
+    # The GroupNutrientStatsRow of the nutrient within the food group, or
+    # None if no food of the group has a value of the nutrient
+    table = model.GroupNutrientStats.__table__
+    rows = queryservice.get_rows(conn, model.GroupNutrientStats,
+                                 and_(table.c.group_id == group_id, table.c.nutrient_id == nutrient_id))
+    return rows[0] if rows else None
+
+def get_top_foods(conn, nutrient_id, limit=10, group_id=None):
+    # The NutrientRankingRows of the limit foods with the highest values of
+    # the nutrient, among all foods or those of the food group
+    table = model.NutrientRanking.__table__
+    if group_id is None:
+        return queryservice.get_rows(conn, model.NutrientRanking,
+                                     and_(table.c.nutrient_id == nutrient_id, table.c.rank <= limit),
+                                     [table.c.rank])
+    return queryservice.get_rows(conn, model.NutrientRanking,
+                                 and_(table.c.nutrient_id == nutrient_id, table.c.group_id == group_id,
+                                      table.c.group_rank <= limit),
+                                 [table.c.group_rank])
+
+def get_percentile_value(conn, nutrient_id, pct, group_id=None):
+    # The nearest-rank percentile of the values of the nutrient, among all
+    # foods or those of the food group, or None if there are none
+    table = model.NutrientRanking.__table__
+    if group_id is None:
+        num_values = conn.execute(select([func.max(table.c.rank)]).
+                                  where(table.c.nutrient_id == nutrient_id)).scalar()
+    else:
+        stats = get_group_nutrient_stats(conn, group_id, nutrient_id)
+        num_values = stats.num_foods if stats else None
+    if not num_values:
+        return None
+
+    rank = get_percentile_index(num_values, pct) + 1
+    if group_id is None:
+        whereclause = and_(table.c.nutrient_id == nutrient_id, table.c.rank == rank)
+    else:
+        whereclause = and_(table.c.nutrient_id == nutrient_id, table.c.group_id == group_id,
+                           table.c.group_rank == rank)
+    return conn.execute(select([table.c.value]).where(whereclause)).scalar()
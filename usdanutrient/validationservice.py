@@ -0,0 +1,345 @@
+import csv
+import io
+import multiprocessing
+import os
+import time
+from decimal import InvalidOperation
+from sqlalchemy import Boolean, Date, Integer, Numeric, String
+import importservice
+import model
+
+# Errors reported per file at most; the others are only counted
+MAX_FILE_ERRORS = 1000
+
+# Columns of the release tables that the custom files look rows up by
+LOOKUP_COLUMNS = {
+    'food': ('id', 'long_desc'),
+    'food_group': ('id', 'name'),
+    'nutrient': ('id', 'name', 'units'),
+    'weight': ('food_id', 'measurement_desc'),
+}
+
+# Values of Boolean columns, besides empty values
+BOOLEAN_VALUES = ('Y', 'N', '0', '1')
+
+# Columns of the custom files, in order
+CUSTOM_FILE_COLUMNS = {
+    'local_food.csv': [(model.Food, 'long_desc'), (model.Food, 'short_desc'), (model.Food, 'manufacturer'),
+                       (model.FoodGroup, 'name'), (model.Food, 'refuse_pct')],
+    'local_food_weight.csv': [(model.Food, 'long_desc'), (model.Weight, 'amount'),
+                              (model.Weight, 'measurement_desc'), (model.Weight, 'grams')],
+    'local_food_weight_alias.csv': [(model.Food, 'long_desc'), (model.Weight, 'measurement_desc'),
+                                    (model.Weight, 'measurement_desc')],
+    'nutrient_category.csv': [(model.NutrientCategory, 'name')],
+    'nutrient_category_map.csv': [(model.Nutrient, 'name'), (model.NutrientCategory, 'name')],
+    'local_food_nutrient_data.csv': [(model.Food, 'long_desc'), (model.Nutrient, 'name'),
+                                     (model.FoodNutrientData, 'value')],
+    'local_food_nutrient_data_alias.csv': [(model.Food, 'long_desc'), (model.Food, 'long_desc')],
+}
+
+class FileErrors(object):
+    # Errors of a file, by line number, of which the first MAX_FILE_ERRORS
+    # are kept
+    def __init__(self, fname):
+        self.fname = fname
+        self.errors = []
+        self.count = 0
+
+    def add(self, line_num, message):
+        self.count += 1
+        if len(self.errors) < MAX_FILE_ERRORS:
+            self.errors.append((line_num, message))
+
+def check_value(col, value):
+    # Returns the value converted as the import converts it, and the error
+    # of the value, if any. Unlike the import, which loads malformed dates
+    # as NULL, invalid dates are errors.
+    col_type = type(col.type)
+    converted = value
+    try:
+        if col_type is Integer:
+            converted = importservice.convert_integer(value)
+        elif col_type is Numeric:
+            converted = importservice.convert_numeric(value)
+        elif col_type is Date:
+            try:
+                converted = importservice.convert_date(value)
+            except ValueError:
+                # e.g. a month of 13
+                converted = None
+            if value and converted is None:
+                return None, "invalid MM/YYYY date '{}' for column '{}'".format(value, col.name)
+        elif col_type is Boolean:
+            if value and value.upper() not in BOOLEAN_VALUES:
+                return None, "invalid boolean '{}' for column '{}'".format(value, col.name)
+            converted = importservice.convert_boolean(value)
+    except (ValueError, InvalidOperation):
+        return None, "invalid {} '{}' for column '{}'".format(col_type.__name__.lower(), value, col.name)
+
+    if converted is None and not col.nullable:
+        return None, "missing value for column '{}'".format(col.name)
+    if col_type is String and col.type.length is not None and len(value) > col.type.length:
+        return converted, "{} characters exceed String({}) of column '{}'".format(
+            len(value), col.type.length, col.name)
+    return converted, None
+
+def scan_release_file(table_class, fname, col_order):
+    # Checks every line of a release file, and collects its primary keys,
+    # the values of its foreign keys, with the line of their first use, and
+    # the columns of LOOKUP_COLUMNS.
+    table = table_class.__table__
+    cols = [table.c[col_name] for col_name in col_order]
+    num_cols = len(cols)
+    pk_inds = [col_order.index(col.name) for col in table.primary_key.columns if col.name in col_order]
+    if len(pk_inds) != len(table.primary_key.columns):
+        # e.g. the artificial primary key of the footnotes
+        pk_inds = None
+    fk_inds = [(ind, list(col.foreign_keys)[0].column) for ind, col in enumerate(cols) if col.foreign_keys]
+    lookup_inds = [col_order.index(col_name) for col_name in LOOKUP_COLUMNS.get(table.name, ())]
+
+    errors = FileErrors(fname)
+    keys = {}
+    references = dict((ind, {}) for ind, ref_col in fk_inds)
+    lookups = []
+    num_rows = 0
+    with io.open(fname, encoding='windows-1252', newline='\n') as f:
+        for line_num, line in enumerate(f, 1):
+            num_rows += 1
+            values = line.rstrip('\r\n').split('^')
+            if len(values) < num_cols:
+                errors.add(line_num, "expected {} values; found {}".format(num_cols, len(values)))
+                continue
+
+            row = []
+            valid = True
+            for col, value in zip(cols, values):
+                converted, error = check_value(col, value.strip().strip('~'))
+                if error:
+                    errors.add(line_num, error)
+                    valid = False
+                row.append(converted)
+            if not valid:
+                continue
+
+            if pk_inds is not None:
+                key = tuple(row[ind] for ind in pk_inds)
+                if key in keys:
+                    errors.add(line_num, "duplicate primary key {} of line {}".format(
+                        key[0] if len(key) == 1 else key, keys[key]))
+                else:
+                    keys[key] = line_num
+            for ind, ref_col in fk_inds:
+                if row[ind] is not None:
+                    references[ind].setdefault(row[ind], line_num)
+            if lookup_inds:
+                lookups.append(tuple(row[ind] for ind in lookup_inds))
+
+    return {
+        'table': table.name,
+        'fname': fname,
+        'rows': num_rows,
+        'errors': errors,
+        'keys': set(key[0] for key in keys) if pk_inds is not None and len(pk_inds) == 1 else None,
+        'references': [(col_order[ind], ref_col.table.name, references[ind]) for ind, ref_col in fk_inds],
+        'lookups': lookups,
+    }
+
+def scan_release_file_worker(task):
+    return scan_release_file(*task)
+
+def check_references(scans):
+    # Checks that every foreign key value of the release files is a key of
+    # the table that it references
+    errors = []
+    for scan in scans.values():
+        file_errors = FileErrors(scan['fname'])
+        for col_name, ref_table, values in scan['references']:
+            ref_scan = scans.get(ref_table)
+            if ref_scan is None:
+                file_errors.add(None, "column '{}' references table '{}', which has no release file".format(
+                    col_name, ref_table))
+                continue
+            if ref_scan['keys'] is None:
+                continue
+            for value, line_num in sorted(values.items(), key=lambda item: item[1]):
+                if value not in ref_scan['keys']:
+                    file_errors.add(line_num, "'{}' of column '{}' is not a key of table '{}'".format(
+                        value, col_name, ref_table))
+        if file_errors.count:
+            errors.append(file_errors)
+    return errors
+
+def decode_custom_value(value):
+    return importservice.LookupCache.normalize(value)
+
+class CustomFileValidator(object):
+    # Replays the lookups of db_import_custom against the rows of the
+    # release files, without a database. Foods added by local_food.csv get
+    # negative ids.
+    def __init__(self, scans):
+        def get_lookups(table_name):
+            return scans[table_name]['lookups'] if table_name in scans else []
+
+        self.food_ids = self.load_ids((long_desc, food_id) for food_id, long_desc in get_lookups('food'))
+        self.food_group_ids = self.load_ids((name, group_id) for group_id, name in get_lookups('food_group'))
+        self.nutrients = get_lookups('nutrient')
+        self.nutrient_ids = self.load_ids((name, nutrient_id) for nutrient_id, name, units in self.nutrients)
+        self.weights = {}
+        for food_id, measurement_desc in get_lookups('weight'):
+            self.weights.setdefault(food_id, []).append(measurement_desc)
+        self.category_ids = {}
+        self.next_id = -1
+
+    load_ids = staticmethod(importservice.LookupCache.load_ids)
+
+    def get_id(self, ids, name, kind, errors, line_num):
+        matches = ids.get(importservice.LookupCache.normalize(name))
+        if not matches:
+            errors.add(line_num, "unable to find {} '{}'".format(kind, name))
+            return None
+        if len(matches) > 1:
+            errors.add(line_num, "multiple results of {} '{}'".format(kind, name))
+            return None
+        return matches[0]
+
+    def get_food_id(self, long_desc, errors, line_num):
+        return self.get_id(self.food_ids, long_desc, 'food', errors, line_num)
+
+    def add_id(self, ids, name):
+        ind = self.next_id
+        self.next_id -= 1
+        ids.setdefault(importservice.LookupCache.normalize(name), []).append(ind)
+        return ind
+
+    def process_local_food(self, row, errors, line_num):
+        for food_id in self.food_ids.pop(decode_custom_value(row[0]), []):
+            self.weights.pop(food_id, None)
+        self.get_id(self.food_group_ids, row[3], 'food group', errors, line_num)
+        self.add_id(self.food_ids, row[0])
+
+    def process_local_food_weight(self, row, errors, line_num):
+        food_id = self.get_food_id(row[0], errors, line_num)
+        if food_id is not None:
+            self.replace_weight(food_id, row[2])
+
+    def process_local_food_weight_alias(self, row, errors, line_num):
+        # The weight of the alias replaces any weight of the same
+        # description before the aliased weight is looked up
+        food_id = self.get_food_id(row[0], errors, line_num)
+        if food_id is None:
+            return
+        weights = self.replace_weight(food_id, row[2])
+        matches = weights[:-1].count(decode_custom_value(row[1]))
+        if matches != 1:
+            errors.add(line_num, "{} weights '{}' of food '{}'".format(
+                'multiple' if matches else 'no', row[1], row[0]))
+
+    def replace_weight(self, food_id, measurement_desc):
+        weights = self.weights.setdefault(food_id, [])
+        measurement_desc = decode_custom_value(measurement_desc)
+        weights[:] = [desc for desc in weights if desc != measurement_desc]
+        weights.append(measurement_desc)
+        return weights
+
+    def process_nutrient_category(self, row, errors, line_num):
+        self.add_id(self.category_ids, row[0])
+
+    def process_nutrient_category_map(self, row, errors, line_num):
+        self.get_id(self.nutrient_ids, row[0], 'nutrient', errors, line_num)
+        self.get_id(self.category_ids, row[1], 'nutrient category', errors, line_num)
+
+    def rename_energy(self):
+        # As db_import_nutrient_category_map_file does
+        names = {'kcal': 'Energy (kcal)', 'kJ': 'Energy (kJ)'}
+        self.nutrient_ids = self.load_ids(
+            (names.get(units, name) if name == 'Energy' else name, nutrient_id)
+            for nutrient_id, name, units in self.nutrients)
+
+    def process_local_food_nutrient_data(self, row, errors, line_num):
+        self.get_food_id(row[0], errors, line_num)
+        self.get_id(self.nutrient_ids, row[1], 'nutrient', errors, line_num)
+
+    def process_local_food_nutrient_data_alias(self, row, errors, line_num):
+        self.get_food_id(row[0], errors, line_num)
+        self.get_food_id(row[1], errors, line_num)
+
+    def validate_file(self, fname, full_fname):
+        cols = [table_class.__table__.c[col_name] for table_class, col_name in CUSTOM_FILE_COLUMNS[fname]]
+        process_row = getattr(self, 'process_' + fname[:-len('.csv')])
+        if fname == 'nutrient_category_map.csv':
+            self.rename_energy()
+
+        errors = FileErrors(full_fname)
+        num_rows = 0
+        with open(full_fname) as f:
+            for line_num, row in enumerate(csv.reader(f, delimiter='|'), 1):
+                num_rows += 1
+                if len(row) < len(cols):
+                    errors.add(line_num, "expected {} values; found {}".format(len(cols), len(row)))
+                    continue
+                for col, value in zip(cols, row):
+                    converted, error = check_value(col, decode_custom_value(value))
+                    if error:
+                        errors.add(line_num, error)
+                process_row(row, errors, line_num)
+        return num_rows, errors
+
+def validate_custom_files(scans, data_dir):
+    # Checks the custom files in the order that db_import_custom imports
+    # them. Returns the number of rows and the FileErrors of each file.
+    validator = CustomFileValidator(scans)
+    results = []
+    for fname in importservice.CUSTOM_IMPORT_ORDER:
+        full_fname = os.path.join(data_dir, fname)
+        if os.access(full_fname, os.R_OK):
+            results.append(validator.validate_file(fname, full_fname))
+    return results
+
+def validate_data(data_dir, custom_data_dir=None, jobs=None):
+    # Checks the release files of data_dir in parallel, with jobs processes
+    # (by default, one per CPU), and then the custom files, if any. Returns
+    # the report, i.e. the rows and errors of each file, and the total
+    # number of errors.
+    start = time.time()
+    tasks = importservice.get_release_file_tasks(data_dir)
+    pool = multiprocessing.Pool(jobs or multiprocessing.cpu_count())
+    try:
+        scans = dict((scan['table'], scan) for scan in
+                     pool.imap_unordered(scan_release_file_worker, tasks.values()))
+    finally:
+        pool.close()
+        pool.join()
+
+    files = []
+    reference_errors = dict((errors.fname, errors) for errors in check_references(scans))
+    for table_name in sorted(scans, key=lambda name: scans[name]['fname']):
+        scan = scans[table_name]
+        errors = scan['errors']
+        if scan['fname'] in reference_errors:
+            for line_num, message in reference_errors[scan['fname']].errors:
+                errors.add(line_num, message)
+        files.append((scan['fname'], scan['rows'], errors))
+    if custom_data_dir:
+        files.extend((errors.fname, num_rows, errors) for num_rows, errors in
+                     validate_custom_files(scans, custom_data_dir))
+
+    return {
+        'files': [{'fname': fname, 'rows': num_rows, 'num_errors': errors.count,
+                   'errors': [{'line': line_num, 'message': message} for line_num, message in errors.errors]}
+                  for fname, num_rows, errors in files],
+        'num_errors': sum(errors.count for fname, num_rows, errors in files),
+        'elapsed_s': time.time() - start,
+    }
+
+def print_validation_report(report):
+    for stats in report['files']:
+        print("{}: {} rows, {} errors".format(stats['fname'], stats['rows'], stats['num_errors']))
+        for error in stats['errors']:
+            if error['line'] is None:
+                print("  {}".format(error['message']))
+            else:
+                print("  line {}: {}".format(error['line'], error['message']))
+        if stats['num_errors'] > len(stats['errors']):
+            print("  ... and {} more".format(stats['num_errors'] - len(stats['errors'])))
+    print("Found {} errors in {} files in {:.2f}s".format(
+        report['num_errors'], len(report['files']), report['elapsed_s']))